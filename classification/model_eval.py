@@ -11,7 +11,7 @@ from spatial_egt.classification.model_eval_utils import (
     learning_curve,
     roc_curve,
 )
-from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.sample_metadata import get_metadata
 
 
 def cross_val(X, y):
@@ -60,14 +60,9 @@ def result_to_dataframe(data_type, label_name, all_df, indices, y_trues, y_probs
     df["correct"] = df["true"] == df["pred"]
 
     df = df.merge(all_df, left_index=True, right_index=True)
-    df["sample"] = df["sample"].astype(str)
-    df = df.set_index(["source", "sample"], drop=True)
-    data_path = get_data_path(data_type, ".")
-    df_labels = pd.read_csv(f"{data_path}/labels.csv")
-    df_labels["sample"] = df_labels["sample"].astype(str)
-    df_labels = df_labels.set_index(["source", "sample"], drop=True)
-    df_labels = df_labels.drop([label_name], axis=1)
-    df = df.merge(df_labels, left_index=True, right_index=True)
+    metadata = get_metadata(data_type)
+    df_labels = metadata.frame([c for c in metadata.df.columns if c != label_name])
+    df = metadata.index_by_id(df).join(df_labels, how="inner")
 
     df["C-A"] = df["c"] - df["a"]
     df["B-D"] = df["b"] - df["d"]
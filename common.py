@@ -2,6 +2,7 @@
 
 import os
 
+from pandas import DataFrame
 from pandas.api.types import is_object_dtype
 
 
@@ -31,10 +32,63 @@ def get_data_path(data_type:str, data_stage:str, timepoint:int=None):
     return data_path
 
 
-def get_spatial_statistic_type(df, spatial_statistic):
+def get_swept_values(stat_name):
+    """Get the values swept by the statistic's arguments in STATISTIC_PARAMS
+
+    :param stat_name: the registered name of the statistic
+    :type stat_name: str
+    :return: the swept values as they appear in column names, of every data type
+    :rtype: set
+    """
+    from spatial_database import STATISTIC_PARAMS
+    stat_params = [STATISTIC_PARAMS.get(stat_name)]
+    stat_params += [params.get(stat_name) for params in STATISTIC_PARAMS.values()
+                    if isinstance(params, dict)]
+    swept = set()
+    for stat_args in stat_params:
+        if not isinstance(stat_args, dict):
+            continue
+        for value in stat_args.values():
+            if isinstance(value, list):
+                swept |= {f"{v}" for v in value}
+    return swept
+
+
+def get_statistic_calculation(spatial_statistic):
+    """Get the registered function of a statistic
+
+    Parameter sweeps name their columns {statistic}_{value}, so a name that is not
+    registered resolves to the statistic if it is a registered name followed by one
+    of the values swept for it in STATISTIC_PARAMS.
+
+    :param spatial_statistic: the name of the statistic or statistic column
+    :type spatial_statistic: str
+    :return: the function calculating the statistic
+    :rtype: function
+    """
     from spatial_database import STATISTIC_REGISTRY
-    stat_calculation = STATISTIC_REGISTRY[spatial_statistic]
-    if is_object_dtype(df[spatial_statistic]):
+    if spatial_statistic in STATISTIC_REGISTRY:
+        return STATISTIC_REGISTRY[spatial_statistic]
+    for i, character in enumerate(spatial_statistic):
+        if character != "_":
+            continue
+        name, value = spatial_statistic[:i], spatial_statistic[i+1:]
+        if name in STATISTIC_REGISTRY and value in get_swept_values(name):
+            return STATISTIC_REGISTRY[name]
+    raise KeyError(f"{spatial_statistic} is not a registered statistic or swept column.")
+
+
+def get_spatial_statistic_type(df, spatial_statistic):
+    """Get if the statistic is a distribution, function, or single value
+
+    :param df: the statistic's DataFrame, or its RaggedStatistic
+    :param spatial_statistic: the name of the statistic
+    :type spatial_statistic: str
+    :return: "distribution", "function", or "value"
+    :rtype: str
+    """
+    stat_calculation = get_statistic_calculation(spatial_statistic)
+    if not isinstance(df, DataFrame) or is_object_dtype(df[spatial_statistic]):
         if stat_calculation.__name__.endswith("dist"):
             return "distribution"
         return "function"
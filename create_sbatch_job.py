@@ -17,8 +17,8 @@ import os
 import sys
 
 
-def sbatch(email, name, time, memory, conda_env, path, node):
-    """Generate sbatch script str"""
+def sbatch(email, name, time, memory, conda_env, path, node, array=None):
+    """Generate sbatch script str, for a job array of the given size if array is given"""
     sbatch_script = [
         "#!/bin/bash --login",
         "#SBATCH --mail-type=FAIL",
@@ -31,14 +31,17 @@ def sbatch(email, name, time, memory, conda_env, path, node):
         f"cd {path}",
         "python3 -m $*\n",
     ]
+    if array is not None:
+        sbatch_script[4] = f"#SBATCH -o out/{name}/%A_%a.out"
+        sbatch_script.insert(4, f"#SBATCH --array=0-{array-1}")
     if node is not None:
         sbatch_script.insert(1, f"#SBATCH -A {node}")
     return "\n".join(sbatch_script)
 
 
-def main(email, name, time, memory, conda_env, path, node=None):
+def main(email, name, time, memory, conda_env, path, node=None, array=None):
     """Generate and save sbatch script based on input arguments"""
-    script = sbatch(email, name, time, memory, conda_env, path, node)
+    script = sbatch(email, name, time, memory, conda_env, path, node, array)
     if not os.path.exists(f"out/{name}"):
         os.makedirs(f"out/{name}")
     with open(f"job_{name}.sb", "w", encoding="UTF-8") as f:
@@ -3,10 +3,10 @@
 import argparse
 
 import matplotlib.pyplot as plt
-import pandas as pd
 import seaborn as sns
 
 from spatial_egt.common import game_colors, get_data_path
+from spatial_egt.data_processing.sample_metadata import get_metadata
 
 
 def plot_gamespace(save_loc, save_name, df, hue):
@@ -32,14 +32,8 @@ def plot_gamespace(save_loc, save_name, df, hue):
 
 
 def get_samples(data_type, source, sample_ids):
-    data_path = get_data_path(data_type, ".")
-    df_labels = pd.read_csv(f"{data_path}/labels.csv")
-    df_labels["sample"] = df_labels["sample"].astype(str)
-    if source is not None:
-        df_labels = df_labels[df_labels["source"] == source]
-    if sample_ids is not None:
-        df_labels = df_labels[df_labels["sample"].isin(sample_ids)]
-    return df_labels
+    metadata = get_metadata(data_type)
+    return metadata.frame(ids=metadata.select(source, sample_ids))
 
 
 def main():
@@ -7,6 +7,9 @@ data_type: the name of the directory in data/ containing the processed/ data
 time: timepoint
 source: the name of the source of the data
 sample_ids: a list of the sample_ids to visualize
+
+Samples are read from data/{data_type}/{time}/store if it has been written by
+processed_to_store, otherwise from the processed csvs.
 """
 
 import sys
@@ -14,24 +17,25 @@ import sys
 from matplotlib.colors import ListedColormap
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 
 from spatial_egt.common import game_colors, get_data_path
+from spatial_egt.data_processing.processed_store import is_store, read_sample
 
 
 def main(data_type, time, source, *sample_ids):
-    processed_data_path = get_data_path(data_type, "processed", time)
+    sample_data_path = f"data/{data_type}/{time}/store"
+    if not is_store(sample_data_path):
+        sample_data_path = get_data_path(data_type, "processed", time)
     image_data_path = get_data_path(data_type, "images", time)
     fig, ax = plt.subplots(1, len(sample_ids), figsize=(5*len(sample_ids), 5))
     if len(sample_ids) == 1:
         ax = [ax]
     for s,sample_id in enumerate(sorted(sample_ids)):
         file_name = f"{source} {sample_id}.csv"
-        df = pd.read_csv(f"{processed_data_path}/{file_name}")
-        df["color"] = df["type"].map({"sensitive":1, "resistant":2})
+        df = read_sample(sample_data_path, file_name)
+        color = df["type"].map({"sensitive":1, "resistant":2}).to_numpy(dtype=int)
         grid = np.zeros((df["y"].max()+1, df["x"].max()+1), dtype=int)
-        for x, y, color in df[["x", "y", "color"]].values:
-            grid[y, x] = color
+        grid[df["y"].to_numpy(), df["x"].to_numpy()] = color
         colors = ListedColormap(
             ["#000000", game_colors["Sensitive Wins"], game_colors["Resistant Wins"]]
         )
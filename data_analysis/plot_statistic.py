@@ -8,6 +8,8 @@ from scipy import stats
 import seaborn as sns
 
 from spatial_egt.common import game_colors, get_data_path, get_spatial_statistic_type
+from spatial_egt.data_processing.ragged_statistics import ragged_exists, read_ragged
+from spatial_egt.data_processing.sample_metadata import get_metadata
 
 
 def plot_funcs(save_loc, file_name, df, label, stat_name, col):
@@ -95,17 +97,9 @@ def plot_values(save_loc, file_name, df, label_name, stat_name, col):
 
 
 def get_data(df_stat, data_type, label_name, stat_name, source="", sample_ids=None):
-    data_path = get_data_path(data_type, ".")
-    df_labels = pd.read_csv(f"{data_path}/labels.csv")
-    df_labels["sample"] = df_labels["sample"].astype(str)
-
-    if source != "":
-        df_labels = df_labels[df_labels["source"] == source]
-    if sample_ids:
-        df_labels = df_labels[df_labels["sample"].isin(sample_ids)]
-
-    df_stat["sample"] = df_stat["sample"].astype(str)
-    df = df_labels.merge(df_stat, on=["source", "sample"])
+    metadata = get_metadata(data_type)
+    df = metadata.join(df_stat[["source", "sample", stat_name]], [label_name],
+                       metadata.select(source, sample_ids))
     df = df[["source", "sample", label_name, stat_name]]
 
     return df
@@ -125,9 +119,19 @@ def agg_plot(df_stat, data_type, time, label_name, stat_name, source, plot):
     plot(save_loc, file_name, df, label_name, stat_name, label_name)
 
 
+def read_statistic(features_data_path, stat_name, source="", sample_ids=None):
+    """Read the statistic's pkl, or only the requested samples if it was saved as ragged"""
+    if ragged_exists(features_data_path, stat_name):
+        df_ragged = read_ragged(features_data_path, stat_name)
+        return df_ragged.to_frame(df_ragged.rows(source, sample_ids))
+    return pd.read_pickle(f"{features_data_path}/{stat_name}.pkl")
+
+
 def main(data_type, time, label_name, stat_name, *filter_args):
     features_data_path = get_data_path(data_type, "statistics")
-    df_stat = pd.read_pickle(f"{features_data_path}/{stat_name}.pkl")
+    source = filter_args[0] if len(filter_args) > 0 else ""
+    sample_ids = filter_args[1:]
+    df_stat = read_statistic(features_data_path, stat_name, source, sample_ids)
     function_type = get_spatial_statistic_type(df_stat, stat_name)
     if function_type == "distribution":
         plot = plot_dists
@@ -139,11 +143,8 @@ def main(data_type, time, label_name, stat_name, *filter_args):
     if len(filter_args) == 0:
         agg_plot(df_stat, data_type, time, label_name, stat_name, "", plot)
     elif len(filter_args) == 1:
-        source = filter_args[0]
         agg_plot(df_stat, data_type, time, label_name, stat_name, source, plot)
     elif len(filter_args) > 1:
-        source = filter_args[0]
-        sample_ids = filter_args[1:]
         idv_plots(df_stat, data_type, time, label_name, stat_name, source, plot, *sample_ids)
 
 
@@ -0,0 +1,169 @@
+"""Benchmark the spatial statistics on synthetic samples.
+
+Synthetic processed samples are generated on an integer lattice for each combination of
+number of cells, dimensions, density (fraction of lattice sites occupied), proportion
+of sensitive cells, and clustering (0 places the types at random, 1 separates them
+into smooth patches). Each statistic is timed with its STATISTIC_PARAMS on every
+sample, keeping the fastest of the repeats, and its scaling with the number of cells
+is fit as seconds = a * cells^b.
+
+Results are saved in data/benchmark/results.csv. With -save_baseline they become the
+baseline, otherwise they are compared to the saved baseline, and the script exits with
+an error if any statistic is slower than threshold times its baseline.
+
+Expected usage:
+python3 -m spatial_egt.data_processing.benchmark_statistics (-dir data_type) (-stat names)
+    (-cells counts) (-dims dims) (-density densities) (-proportion proportions)
+    (-clustering clusterings) (-repeats repeats) (-threshold threshold) (-save_baseline)
+
+Where:
+-dir: the data type whose STATISTIC_PARAMS are used
+"""
+
+import argparse
+from itertools import product
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter
+
+from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.processed_to_statistic import evaluate_statistic, get_statistics
+from spatial_egt.data_processing.run_ledger import fit_cost
+
+
+CASE_COLUMNS = ["cells", "dims", "density", "proportion", "clustering"]
+BASELINE_FILE = "baseline.json"
+
+
+def generate_sample(cells, dims=2, density=0.5, proportion=0.5, clustering=0.0, seed=0):
+    """Synthetic processed sample with columns x, y, (z), type
+
+    The cells occupy distinct sites of a square (or cubic) lattice sized so that the
+    given fraction of its sites is occupied. Cells are sensitive where a mix of a
+    smooth random field (weighted by clustering) and independent noise is below the
+    quantile giving the proportion of sensitive cells.
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil((cells / density)**(1/dims)))
+    shape = (side,)*dims
+    sites = rng.choice(side**dims, size=cells, replace=False)
+    coords = np.stack(np.unravel_index(sites, shape), axis=1)
+
+    field = gaussian_filter(rng.standard_normal(shape), sigma=max(side/10, 1), mode="wrap")
+    field = field[tuple(coords.T)]
+    field = (field - field.mean()) / (field.std() or 1)
+    score = clustering*field + (1 - clustering)*rng.standard_normal(cells)
+    sensitive = score <= np.quantile(score, proportion)
+
+    df = pd.DataFrame(coords, columns=["x", "y", "z"][:dims])
+    df["type"] = np.where(sensitive, "sensitive", "resistant")
+    return df
+
+
+def time_statistic(df, stat_name, stat_calculation, stat_args, repeats):
+    """Fastest time in seconds of calculating the statistic on a fresh copy of the sample
+
+    Each repeat uses a new copy so nothing cached on the sample is reused.
+    """
+    times = []
+    for _ in range(repeats):
+        df_copy = df.copy()
+        start = time.perf_counter()
+        evaluate_statistic(df_copy, stat_name, stat_calculation, stat_args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_benchmark(statistics, cases, repeats=1):
+    """Time each statistic on the sample of each case"""
+    rows = []
+    for case in cases:
+        df = generate_sample(**case)
+        for stat_name, (stat_calculation, stat_args) in statistics.items():
+            row = {"statistic": stat_name} | case
+            try:
+                row["seconds"] = time_statistic(df, stat_name, stat_calculation, stat_args, repeats)
+            except Exception as e:
+                row["seconds"] = np.nan
+                row["error"] = str(e)
+            print(" ".join(f"{k}={v}" for k, v in row.items()))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def scaling_curves(df):
+    """Fit of seconds against number of cells for each statistic and case without cells"""
+    rows = []
+    group_columns = ["statistic"] + CASE_COLUMNS[1:]
+    for group, df_group in df.dropna(subset=["seconds"]).groupby(group_columns):
+        a, b = fit_cost(df_group["cells"].values.astype(float), df_group["seconds"].values)
+        rows.append(dict(zip(group_columns, group)) | {"cost_coefficient": a, "cost_exponent": b})
+    return pd.DataFrame(rows)
+
+
+def case_key(row):
+    return " ".join([row["statistic"]] + [f"{c}={row[c]}" for c in CASE_COLUMNS])
+
+
+def find_regressions(df, baseline, threshold):
+    """Rows slower than threshold times their baseline, with the ratio"""
+    df = df.copy()
+    df["baseline"] = [baseline.get(case_key(row), np.nan) for _, row in df.iterrows()]
+    df["ratio"] = df["seconds"] / df["baseline"]
+    return df[df["ratio"] > threshold]
+
+
+def main():
+    """Benchmark the spatial statistics and check for regressions"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--data_type", type=str, default="in_silico")
+    parser.add_argument("-stat", "--statistic", type=str, nargs="+", default=["all"])
+    parser.add_argument("-cells", "--cells", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("-dims", "--dims", type=int, nargs="+", default=[2])
+    parser.add_argument("-density", "--density", type=float, nargs="+", default=[0.5])
+    parser.add_argument("-proportion", "--proportion", type=float, nargs="+", default=[0.5])
+    parser.add_argument("-clustering", "--clustering", type=float, nargs="+", default=[0.0, 0.8])
+    parser.add_argument("-repeats", "--repeats", type=int, default=3)
+    parser.add_argument("-threshold", "--threshold", type=float, default=1.25)
+    parser.add_argument("-save_baseline", "--save_baseline", action="store_true")
+    args = parser.parse_args()
+
+    statistics = get_statistics(args.data_type, args.statistic)
+    cases = [dict(zip(CASE_COLUMNS, values)) for values in product(
+        args.cells, args.dims, args.density, args.proportion, args.clustering
+    )]
+    df = run_benchmark(statistics, cases, args.repeats)
+
+    save_loc = get_data_path("benchmark", ".")
+    df.to_csv(f"{save_loc}/results.csv", index=False)
+    curves = scaling_curves(df)
+    curves.to_csv(f"{save_loc}/scaling.csv", index=False)
+    print(curves.to_string(index=False, float_format="{:.4g}".format))
+
+    baseline_file = f"{save_loc}/{BASELINE_FILE}"
+    if args.save_baseline:
+        baseline = {case_key(row): row["seconds"] for _, row in df.iterrows()}
+        with open(baseline_file, "w", encoding="UTF-8") as f:
+            json.dump(baseline, f, indent=1)
+        return
+    if not os.path.exists(baseline_file):
+        print("No baseline to compare to, save one with -save_baseline")
+        return
+    with open(baseline_file, encoding="UTF-8") as f:
+        baseline = json.load(f)
+    regressions = find_regressions(df, baseline, args.threshold)
+    if len(regressions) > 0:
+        print(f"Slower than {args.threshold} times the baseline:")
+        print(regressions[["statistic"] + CASE_COLUMNS + ["seconds", "baseline", "ratio"]]
+              .to_string(index=False, float_format="{:.4g}".format))
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Check that the faster ways of calculating the statistics match the direct ways.
+
+Each check calculates statistics on synthetic samples (see benchmark_statistics) in two
+ways that should agree and returns the largest absolute difference of each compared
+value. The script exits with an error if any difference is above TOLERANCE.
+Comparisons of statistics calculated through muspan_statistics are skipped if muspan
+is not installed.
+
+Expected usage:
+python3 -m spatial_egt.data_processing.check_statistics (-check names) (-seeds seeds)
+
+Where:
+-check: the checks in CHECKS to run, all of them by default
+"""
+
+import argparse
+from importlib.util import find_spec
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from spatial_egt.data_processing.benchmark_statistics import generate_sample
+from spatial_egt.data_processing.processed_to_statistic import evaluate_statistic
+from spatial_egt.data_processing.spatial_statistics import lattice as lt
+from spatial_egt.data_processing.spatial_statistics.alpha_shapes import alpha_shape_patches
+from spatial_egt.data_processing.spatial_statistics.custom import nc_dist
+from spatial_egt.data_processing.statistics_to_features import function_to_features
+
+
+TOLERANCE = 1e-9
+
+
+def difference(a, b):
+    """Largest absolute difference of two arrays, inf if their shapes or nans differ"""
+    a = np.atleast_1d(np.asarray(a, dtype=float))
+    b = np.atleast_1d(np.asarray(b, dtype=float))
+    if a.shape != b.shape or not np.array_equal(np.isnan(a), np.isnan(b)):
+        return np.inf
+    keep = ~np.isnan(a)
+    if not np.any(keep):
+        return 0.0
+    with np.errstate(invalid="ignore"):
+        diff = np.abs(a[keep] - b[keep])
+    # matching infinities are equal
+    return float(np.max(np.where(a[keep] == b[keep], 0, diff)))
+
+
+def lattice_type_coords(df):
+    return {cell_type: df.loc[df["type"] == cell_type, ["x", "y"]].values.astype(int)
+            for cell_type in lt.CELL_TYPES}
+
+
+def check_incremental_lattice(seed):
+    """Statistics of an IncrementalLattice against a fresh lattice after the sample shrank
+
+    The incremental lattice's grid still covers the first timepoint, so its statistics
+    have to be calculated within the current timepoint's bounds.
+    """
+    df_first = generate_sample(4000, clustering=0.8, seed=seed)
+    upper = df_first[["x", "y"]].max().values
+    df_shrunk = df_first[(df_first["x"] > upper[0]//8) & (df_first["x"] < upper[0]*2//3)
+                         & (df_first["y"] < upper[1]//2)].reset_index(drop=True)
+    radii = np.arange(0, 11)
+
+    def statistics(lattice):
+        return {
+            "cross_k": lt.cross_k_function(lattice, "sensitive", "resistant", radii),
+            "cross_k same type": lt.cross_k_function(lattice, "sensitive", "sensitive", radii),
+            "cpcf": lt.cross_pair_correlation(lattice, "sensitive", "resistant", radii, 2),
+            "neighbor counts": lattice.neighbor_type_counts("resistant", lt.CELL_TYPES, 3),
+            "qcm": lt.quadrat_correlation(lattice, 5, iterations=100, seed=seed),
+        }
+
+    incremental = lt.IncrementalLattice(df_first[["x", "y"]].min().values, upper)
+    incremental.update(lattice_type_coords(df_first))
+    statistics(incremental)  # fill the cache, as at the first timepoint of a timeseries
+    incremental.update(lattice_type_coords(df_shrunk))
+    fresh = lt.Lattice(lattice_type_coords(df_shrunk))
+    updated, expected = statistics(incremental), statistics(fresh)
+    return {name: difference(updated[name], expected[name]) for name in expected}
+
+
+def sweep_differences(df, stat_name, stat_calculation, stat_args, sweep_arg):
+    """Each column of a sweep in one call against calculating its value on its own"""
+    swept = evaluate_statistic(df.copy(), stat_name, stat_calculation, stat_args)
+    differences = {}
+    for value in stat_args[sweep_arg]:
+        single = stat_calculation(df.copy(), **(stat_args | {sweep_arg: value}))
+        differences[f"{stat_name}_{value}"] = difference(swept[f"{stat_name}_{value}"], single)
+    return differences
+
+
+def check_sweeps(seed):
+    """Sweeps sharing their precomputation against calculating each value on its own"""
+    df = generate_sample(3000, clustering=0.8, seed=seed)
+    df_float = df.assign(x=df["x"] + 0.5)  # not on a lattice, so nc_dist uses the trees
+    differences = {}
+    differences |= sweep_differences(df, "nc_dist", nc_dist, {"radius": [1, 2.5, 4]}, "radius")
+    differences |= sweep_differences(df_float, "nc_dist tree", nc_dist,
+                                     {"radius": [1, 2.5, 4]}, "radius")
+
+    # quadrats summed from the finest quadrats against rasterizing each side length
+    lattice = lt.Lattice(lattice_type_coords(df))
+    for side_length in [2, 4, 6, 10]:
+        for cell_type in lt.CELL_TYPES:
+            fresh = lt.Lattice(lattice_type_coords(df))
+            differences[f"quadrat counts {cell_type} {side_length}"] = difference(
+                lattice.quadrat_counts(cell_type, side_length, base_side_length=2),
+                fresh.quadrat_counts(cell_type, side_length)
+            )
+        differences[f"quadrat correlation {side_length}"] = difference(
+            lt.quadrat_correlation(lattice, side_length, 100, seed, base_side_length=2),
+            lt.quadrat_correlation(lt.Lattice(lattice_type_coords(df)), side_length, 100, seed)
+        )
+
+    # patches of every alpha from one triangulation against a triangulation per alpha
+    for alpha in [1.5, 3, 6]:
+        count, areas, circularities = alpha_shape_patches(df, "sensitive", alpha)
+        fresh = alpha_shape_patches(df.copy(), "sensitive", alpha)
+        differences[f"patch areas {alpha}"] = difference(areas, fresh[1])
+        differences[f"patch circularities {alpha}"] = difference(circularities, fresh[2])
+
+    if find_spec("muspan") is not None:
+        from spatial_egt.data_processing.spatial_statistics import muspan_statistics as mss
+        for stat_name in ["patch_count", "area_dist", "circularity_dist"]:
+            stat_args = {"cell_type": "sensitive", "alpha": [1.5, 3, 6], "backend": "fast"}
+            differences |= sweep_differences(df, stat_name, getattr(mss, stat_name),
+                                             stat_args, "alpha")
+        stat_args = {"side_length": [2, 4, 6], "backend": "lattice", "seed": seed}
+        differences |= sweep_differences(df, "qcm", mss.qcm, stat_args, "side_length")
+    return differences
+
+
+def check_function_features(seed):
+    """Function features of every sample at once against np.nanmin and np.nanmax of each
+
+    The functions contain NaN and infinite values, and one is only NaN.
+    """
+    rng = np.random.default_rng(seed)
+    functions = [rng.normal(size=rng.integers(1, 20)) for _ in range(50)]
+    for function in functions[:25]:
+        function[rng.random(len(function)) < 0.3] = np.nan
+    functions[0][0] = np.nan
+    functions[1][-1] = np.inf
+    functions[2][:] = np.nan
+    offsets = np.concatenate(([0], np.cumsum([len(f) for f in functions])))
+    df = function_to_features(pd.DataFrame(index=range(len(functions))), "f",
+                              np.concatenate(functions), offsets)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all NaN function
+        return {
+            "min": difference(df["f_Min"], [np.nanmin(f) for f in functions]),
+            "max": difference(df["f_Max"], [np.nanmax(f) for f in functions]),
+        }
+
+
+CHECKS = {
+    "incremental_lattice": check_incremental_lattice,
+    "sweeps": check_sweeps,
+    "function_features": check_function_features,
+}
+
+
+def main():
+    """Run the checks and exit with an error if any differences are above the tolerance"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-check", "--check", type=str, nargs="+", default=list(CHECKS))
+    parser.add_argument("-seeds", "--seeds", type=int, nargs="+", default=[0, 1])
+    args = parser.parse_args()
+
+    failed = False
+    for check_name in args.check:
+        for seed in args.seeds:
+            for name, diff in CHECKS[check_name](seed).items():
+                passed = diff <= TOLERANCE
+                failed |= not passed
+                print(f"{check_name} seed={seed} {name}: {diff:.3g} {'ok' if passed else 'FAILED'}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
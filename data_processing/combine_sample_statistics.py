@@ -3,36 +3,79 @@
 For use when processed_to_statistics was run over individual samples.
 
 Expected usage: python3 -m spatial_egt.data_processing.combine_sample_statistics
-    data_type statistic_name time
+    data_type statistic_name time (workers)
 
 where:
 data_type: the name of the directory in data/
 statisitic_name: the name of directory in data/{data_type}/statisitcs
-    that holds the individual samples
+    that holds the individual samples, several names can be separated by commas
+    and "all" combines every directory (except ragged statistics)
 time: timepoint
+workers: optional, the number of threads reading pkls (default 8)
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys
 
 import pandas as pd
 
 from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.ragged_statistics import RAGGED_SUFFIX
 
 
-def main(data_type, statistic_name, time):
+BATCH_SIZE = 1000
+
+
+def read_columns(file_name):
+    """Read a sample's statistic pkl as a dict of column lists"""
+    df = pd.read_pickle(file_name)
+    return {column: df[column].tolist() for column in df.columns}
+
+
+def combine_statistic(statistics_path, workers):
+    """Read every sample pkl in statistics_path and combine them into one DataFrame
+
+    The pkls are read by a thread pool in batches, so at most one batch of sample
+    DataFrames is alive at once. Their rows are appended to per-column lists and the
+    combined DataFrame is built from them in a single allocation at the end.
+    """
+    file_names = sorted(os.listdir(statistics_path))
+    columns = {}
+    num_rows = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(0, len(file_names), BATCH_SIZE):
+            batch = [f"{statistics_path}/{f}" for f in file_names[i : i + BATCH_SIZE]]
+            for sample_columns in executor.map(read_columns, batch):
+                sample_rows = 0
+                for column, values in sample_columns.items():
+                    if column not in columns:
+                        columns[column] = [None]*num_rows
+                    columns[column].extend(values)
+                    sample_rows = len(values)
+                num_rows += sample_rows
+                for values in columns.values():
+                    values.extend([None]*(num_rows - len(values)))
+    return pd.DataFrame(columns)
+
+
+def main(data_type, statistic_name, time, workers=8):
     """Combine individual sample's spatial statistics"""
     save_loc = get_data_path(data_type, "statistics", time)
-    statistics_path = f"{save_loc}/{statistic_name}"
-    df = pd.DataFrame()
-    for file_name in os.listdir(statistics_path):
-        df_sample = pd.read_pickle(f"{statistics_path}/{file_name}")
-        df = pd.concat([df, df_sample])
-    df.to_pickle(f"{save_loc}/{statistic_name}.pkl")
+    if statistic_name == "all":
+        statistic_names = [
+            f for f in os.listdir(save_loc)
+            if os.path.isdir(f"{save_loc}/{f}") and not f.endswith(RAGGED_SUFFIX)
+        ]
+    else:
+        statistic_names = statistic_name.split(",")
+    for name in statistic_names:
+        df = combine_statistic(f"{save_loc}/{name}", int(workers))
+        df.to_pickle(f"{save_loc}/{name}.pkl")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 4:
+    if len(sys.argv) in (4, 5):
         main(*sys.argv[1:])
     else:
         print("Please see the module docstring for usage instructions.")
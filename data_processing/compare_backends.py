@@ -0,0 +1,139 @@
+"""Compare the fast point pattern backend of the statistics to muspan.
+
+cross_k, cpcf, nn_dist, and anni are calculated with backend="fast" (see point_pattern)
+and with muspan on synthetic samples, and on processed samples if -dir is given, for
+each pair of cell types. The deviation of a fast value from muspan's is its absolute
+difference divided by the larger of the muspan value's magnitude and 1, so it is relative
+for K-function values and absolute for pair correlations near 1. Nearest neighbour
+distances are compared after sorting. The script exits with an error if the largest
+deviation of any statistic is above its tolerance in TOLERANCES, and skips the
+comparison if muspan is not installed. The tolerances are provisional until they are
+set from the deviations this script reports.
+
+qcm with backend="lattice" is also compared to muspan's qcm, on the samples with
+integer coordinates. Its null distribution differs from muspan's, so the two are not
+expected to agree and its deviation is only reported.
+
+Expected usage:
+python3 -m spatial_egt.data_processing.compare_backends (-dir data_type) (-time time)
+    (-samples num_samples) (-cells counts) (-seeds seeds)
+
+Where:
+-dir: also compare on the first num_samples processed samples of the data type and time
+"""
+
+import argparse
+from importlib.util import find_spec
+from itertools import product
+import sys
+
+import numpy as np
+
+from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.benchmark_statistics import generate_sample
+from spatial_egt.data_processing.processed_store import read_sample
+from spatial_egt.data_processing.processed_to_store import get_sample_file_names
+from spatial_egt.data_processing.spatial_statistics import lattice as lt
+
+
+# largest allowed deviation of backend="fast" from muspan, None to only report it.
+# Provisional: these were not derived from muspan output (muspan could not be run where
+# the fast backend was written), they are the expected size of differences in edge
+# correction for K and the pcf and exact agreement for nearest neighbours. Replace them
+# with the deviations observed by running this script with muspan installed.
+TOLERANCES = {"cross_k": 0.02, "cpcf": 0.05, "nn_dist": 1e-9, "anni": 1e-3, "qcm": None}
+STATISTIC_ARGS = {
+    "cross_k": {"max_radius": 10, "step": 1},
+    "cpcf": {"max_radius": 10, "annulus_step": 1, "annulus_width": 2},
+    "nn_dist": {},
+    "anni": {},
+}
+QCM_ARGS = {"side_length": 10}
+CELL_TYPE_PAIRS = [("sensitive", "resistant"), ("resistant", "sensitive"), ("sensitive", "sensitive")]
+
+
+def deviation(fast, reference, sort=False):
+    """Largest deviation of the fast values from the reference values"""
+    fast = np.atleast_1d(np.asarray(fast, dtype=float))
+    reference = np.atleast_1d(np.asarray(reference, dtype=float))
+    if sort:
+        fast, reference = np.sort(fast), np.sort(reference)
+    if fast.shape != reference.shape or not np.array_equal(np.isnan(fast), np.isnan(reference)):
+        return np.inf
+    keep = ~np.isnan(reference)
+    if not np.any(keep):
+        return 0.0
+    scale = np.maximum(np.abs(reference[keep]), 1)
+    return np.max(np.abs(fast[keep] - reference[keep]) / scale)
+
+
+def compare_sample(df, name):
+    """Deviation of each statistic and pair of cell types on one sample"""
+    from spatial_egt.data_processing.spatial_statistics import muspan_statistics as mss
+
+    rows = []
+    for stat_name, (cell_type1, cell_type2) in product(STATISTIC_ARGS, CELL_TYPE_PAIRS):
+        stat_calculation = getattr(mss, stat_name)
+        stat_args = STATISTIC_ARGS[stat_name] | {"cell_type1": cell_type1, "cell_type2": cell_type2}
+        fast = stat_calculation(df, **stat_args, backend="fast")
+        reference = stat_calculation(df, **stat_args, backend="muspan")
+        rows.append({
+            "sample": name,
+            "statistic": stat_name,
+            "cell_types": f"{cell_type1}-{cell_type2}",
+            "deviation": deviation(fast, reference, sort=stat_name == "nn_dist"),
+        })
+    if lt.get_lattice(df) is not None:
+        rows.append({
+            "sample": name,
+            "statistic": "qcm",
+            "cell_types": "sensitive-resistant",
+            "deviation": deviation(mss.qcm(df, **QCM_ARGS, backend="lattice", seed=0),
+                                   mss.qcm(df, **QCM_ARGS)),
+        })
+    return rows
+
+
+def main():
+    """Compare backend="fast" to muspan and exit with an error if they disagree"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--data_type", type=str, default=None)
+    parser.add_argument("-time", "--time", type=int, default=72)
+    parser.add_argument("-samples", "--num_samples", type=int, default=5)
+    parser.add_argument("-cells", "--cells", type=int, nargs="+", default=[500, 2000])
+    parser.add_argument("-seeds", "--seeds", type=int, nargs="+", default=[0, 1])
+    args = parser.parse_args()
+
+    if find_spec("muspan") is None:
+        print("muspan is not installed, skipping the comparison")
+        return
+
+    rows = []
+    for cells, clustering, seed in product(args.cells, [0.0, 0.8], args.seeds):
+        df = generate_sample(cells, clustering=clustering, seed=seed)
+        rows += compare_sample(df, f"synthetic cells={cells} clustering={clustering} seed={seed}")
+    if args.data_type is not None:
+        data_path = get_data_path(args.data_type, "processed", args.time)
+        for file_name in get_sample_file_names(data_path)[:args.num_samples]:
+            rows += compare_sample(read_sample(data_path, file_name), file_name)
+
+    failed = False
+    for stat_name, tolerance in TOLERANCES.items():
+        stat_rows = [row for row in rows if row["statistic"] == stat_name]
+        if len(stat_rows) == 0:
+            continue
+        worst = max(stat_rows, key=lambda row: row["deviation"])
+        if tolerance is None:
+            print(f"{stat_name}: max deviation {worst['deviation']:.3g} (not checked) "
+                  f"on {worst['sample']} {worst['cell_types']}")
+            continue
+        passed = worst["deviation"] <= tolerance
+        failed |= not passed
+        print(f"{stat_name}: max deviation {worst['deviation']:.3g} (tolerance {tolerance:g}) "
+              f"on {worst['sample']} {worst['cell_types']} {'ok' if passed else 'FAILED'}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Read processed samples from a binary columnar store.
+
+A store holds every sample of one data_type/timepoint as flat binary arrays:
+one array per coordinate column, a uint8 array of cell type codes, and the offsets
+of each sample within those arrays. The arrays are memory-mapped, so reading a
+sample slices the store without parsing or copying the coordinates.
+
+Stores are written by processed_to_store.
+"""
+
+from functools import lru_cache
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+CELL_TYPES = ["sensitive", "resistant"]
+META_FILE = "meta.json"
+SAMPLES_FILE = "samples.csv"
+
+
+def is_store(store_path):
+    """Check if a store has been written to the given directory"""
+    return os.path.exists(f"{store_path}/{META_FILE}")
+
+
+class ProcessedStore:
+    """Memory-mapped view of a store directory"""
+
+    def __init__(self, store_path):
+        with open(f"{store_path}/{META_FILE}", encoding="UTF-8") as f:
+            meta = json.load(f)
+        self.path = store_path
+        self.columns = meta["columns"]
+        num_cells = meta["num_cells"]
+        self.coords = {
+            column: np.memmap(f"{store_path}/{column}.bin", dtype=meta["coord_dtype"],
+                              mode="r", shape=(num_cells,))
+            for column in self.columns
+        }
+        self.types = np.memmap(f"{store_path}/type.bin", dtype=np.uint8, mode="r",
+                               shape=(num_cells,))
+        self.offsets = np.fromfile(f"{store_path}/offsets.bin", dtype=np.int64)
+        self.samples = pd.read_csv(f"{store_path}/{SAMPLES_FILE}", dtype=str)
+        self.sample_index = {
+            f"{source} {sample}.csv": i
+            for i, (source, sample) in enumerate(self.samples[["source", "sample"]].values)
+        }
+
+    def __len__(self):
+        return len(self.samples)
+
+    def file_names(self):
+        """Processed file names of the samples in the store, in store order"""
+        return list(self.sample_index.keys())
+
+    def sample_arrays(self, i):
+        """Views of the coordinate columns and type codes of the ith sample"""
+        start, stop = self.offsets[i], self.offsets[i+1]
+        coords = {column: values[start:stop] for column, values in self.coords.items()}
+        return coords, self.types[start:stop]
+
+    def sample_frame(self, i):
+        """The ith sample as a processed DataFrame backed by the store's arrays
+
+        The type column is categorical, so it compares equal to the type strings
+        without ever materializing them.
+        """
+        coords, types = self.sample_arrays(i)
+        data = dict(coords)
+        data["type"] = pd.Categorical.from_codes(types, categories=CELL_TYPES)
+        return pd.DataFrame(data, copy=False)
+
+
+@lru_cache(maxsize=None)
+def open_store(store_path):
+    """Open the store at store_path once per process"""
+    return ProcessedStore(store_path)
+
+
+def read_sample(data_path, file_name):
+    """Read a sample from either a store or a directory of processed csvs"""
+    if is_store(data_path):
+        store = open_store(data_path)
+        return store.sample_frame(store.sample_index[file_name])
+    return pd.read_csv(f"{data_path}/{file_name}")
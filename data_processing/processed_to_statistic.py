@@ -1,14 +1,43 @@
-"""Convert processed samples into a given spatial statistic.
+"""Convert processed samples into the given spatial statistic(s).
 
-This script can calculate the spatial statistic for each sample or for individual samples
+This script can calculate the spatial statistics for each sample or for individual samples.
+Several statistics (or "all") can be given to -stat, in which case each sample is
+loaded once and every statistic is calculated on it before moving to the next sample.
+With -store the samples are read from the binary store written by processed_to_store.
+With -cache results are reused from, and saved to, the statistic_cache of the data_type.
+With -samples only the samples listed in the given file (one file name per line) are
+calculated and each is saved individually, as for -source and -sample. "%a" in the
+file name is replaced by the SLURM array task id, so each task of a job array
+calculates its own shard (see write_statistics_bash).
+With -ledger the cost of each statistic on each sample is recorded in the run_ledger.
+With -ragged distribution and function statistics of all samples are saved in the
+ragged_statistics format instead of as pkls.
+
+Approximate statistics (see approximate) save their confidence interval and budget
+in the columns {statistic}_lower, {statistic}_upper, and {statistic}_budget.
+
+A list of values for one of a statistic's arguments in STATISTIC_PARAMS is a parameter
+sweep, which saves one column per value named {statistic}_{value}.
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
 
 import pandas as pd
 
 from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.processed_store import open_store, read_sample
+from spatial_egt.data_processing.processed_to_store import get_sample_file_names
+from spatial_egt.data_processing.ragged_statistics import (
+    RAGGED_SUFFIX,
+    is_ragged_statistic,
+    write_ragged,
+)
+from spatial_egt.data_processing.run_ledger import LEDGER_FILE, RunLedger
+from spatial_egt.data_processing.spatial_statistics.approximate import Approximation
+from spatial_egt.data_processing.statistic_cache import MISS, StatisticCache, get_sample_hash
 from spatial_database import STATISTIC_PARAMS, STATISTIC_REGISTRY
 
 
@@ -24,20 +53,162 @@ def get_statistic_calculation_arguments(data_type, stat_name):
     return stat_args
 
 
-def calculate_statistics(processed_path, file_names, stat_name, stat_calculation, stat_args):
-    """Calulate the spatial statistic of the given sample files"""
-    rows = []
-    for file_name in file_names:
+def get_statistics(data_type, stat_names):
+    """Get the calculation function and arguments of each statistic name
+
+    "all" selects every statistic in the registry.
+    """
+    if stat_names == ["all"]:
+        stat_names = list(STATISTIC_REGISTRY.keys())
+    return {
+        stat_name: (STATISTIC_REGISTRY[stat_name],
+                     get_statistic_calculation_arguments(data_type, stat_name))
+        for stat_name in stat_names
+    }
+
+
+def expand_approximations(columns):
+    """Replace Approximation results with their estimate, bounds, and budget columns"""
+    expanded = {}
+    for name, statistic in columns.items():
+        if isinstance(statistic, Approximation):
+            expanded |= statistic.columns(name)
+        else:
+            expanded[name] = statistic
+    return expanded
+
+
+def evaluate_statistic(df_sample, stat_name, stat_calculation, stat_args):
+    """Calculate a statistic on a sample, returning its value under each column name
+
+    Statistics that list the swept argument in their sweep_params attribute calculate
+    every value in one call (sharing their expensive precomputation), the others are
+    called once per value.
+    """
+    sweep_args = [arg for arg, value in stat_args.items() if isinstance(value, list)]
+    if len(sweep_args) == 0:
+        return expand_approximations({stat_name: stat_calculation(df_sample, **stat_args)})
+    if len(sweep_args) > 1:
+        raise ValueError(f"Only one argument can be swept, got {sweep_args}.")
+    sweep_arg = sweep_args[0]
+    if sweep_arg in getattr(stat_calculation, "sweep_params", ()):
+        statistics = stat_calculation(df_sample, **stat_args)
+    else:
+        statistics = {
+            value: stat_calculation(df_sample, **(stat_args | {sweep_arg: value}))
+            for value in stat_args[sweep_arg]
+        }
+    return expand_approximations(
+        {f"{stat_name}_{value}": statistic for value, statistic in statistics.items()}
+    )
+
+
+def calculate_sample_statistics(data_path, statistics, file_name, cache=None, ledger=None):
+    """Calculate each spatial statistic of one sample file
+
+    The sample is read once and the same DataFrame is passed to every statistic,
+    so structures cached on it (see sample_context) are shared between them.
+    If a StatisticCache is given, cached results are reused and the sample is only
+    read when at least one statistic misses the cache.
+    If a RunLedger is given, the cost of each statistic is recorded in it.
+    Statistics that failed are left out of the returned rows.
+    """
+    try:
+        source = file_name.split(" ")[0]
+        sample = file_name.split(" ")[1][:-4]
+    except Exception as e:
+        print(f"Error {file_name}: {e}")
+        return {}
+    rows = {}
+    cache_keys = {}
+    if cache is not None:
         try:
-            source = file_name.split(" ")[0]
-            sample = file_name.split(" ")[1][:-4]
-            df_sample = pd.read_csv(f"{processed_path}/{file_name}")
-            statistic = stat_calculation(df_sample, **stat_args)
+            sample_hash = get_sample_hash(data_path, file_name)
         except Exception as e:
             print(f"Error {file_name}: {e}")
+            return {}
+        for stat_name, (stat_calculation, stat_args) in statistics.items():
+            cache_keys[stat_name] = cache.key(sample_hash, stat_name, stat_calculation, stat_args)
+            columns = cache.load(stat_name, cache_keys[stat_name])
+            if columns is not MISS:
+                rows[stat_name] = {"source": source, "sample": sample} | columns
+                if ledger is not None:
+                    ledger.record_cached(stat_name, source, sample)
+    if len(rows) == len(statistics):
+        return rows
+
+    try:
+        df_sample = read_sample(data_path, file_name)
+    except Exception as e:
+        print(f"Error {file_name}: {e}")
+        return rows
+    for stat_name, (stat_calculation, stat_args) in statistics.items():
+        if stat_name in rows:
             continue
-        rows.append({"source": source, "sample": sample, stat_name: statistic})
-    return pd.DataFrame(rows)
+        try:
+            if ledger is None:
+                columns = evaluate_statistic(df_sample, stat_name, stat_calculation, stat_args)
+            else:
+                with ledger.measure(stat_name, source, sample, len(df_sample)):
+                    columns = evaluate_statistic(df_sample, stat_name, stat_calculation, stat_args)
+        except Exception as e:
+            print(f"Error {file_name} {stat_name}: {e}")
+            continue
+        if cache is not None:
+            cache.save(stat_name, cache_keys[stat_name], columns)
+        rows[stat_name] = {"source": source, "sample": sample} | columns
+    return rows
+
+
+def calculate_statistics(data_path, file_names, statistics, workers=1, cache=None, ledger=None):
+    """Calulate the spatial statistics of the given sample files
+
+    data_path is either the processed directory or a store directory.
+    With more than one worker the samples are spread across a process pool,
+    rows are returned in the same order as file_names either way.
+    Returns a DataFrame for each statistic name.
+    """
+    calculate_sample = partial(calculate_sample_statistics, data_path, statistics,
+                               cache=cache, ledger=ledger)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(file_names) // (4 * workers))
+            sample_rows = list(executor.map(calculate_sample, file_names, chunksize=chunksize))
+    else:
+        sample_rows = [calculate_sample(file_name) for file_name in file_names]
+    return {
+        stat_name: pd.DataFrame([rows[stat_name] for rows in sample_rows if stat_name in rows])
+        for stat_name in statistics
+    }
+
+
+def get_file_names(data_path, store=False):
+    """Names of every sample file in the processed directory or store"""
+    if store:
+        return open_store(data_path).file_names()
+    return get_sample_file_names(data_path)
+
+
+def save_statistics(dfs, statistics_path, ragged=False):
+    """Save each statistic's DataFrame of all samples into the statistics directory
+
+    With ragged, statistics whose columns are all distributions or functions are saved
+    in the ragged_statistics format, one {column}.ragged directory per column.
+    Returns the names of the saved files.
+    """
+    saved = []
+    for stat_name, df in dfs.items():
+        if len(df) == 0:
+            continue
+        columns = [c for c in df.columns if c not in ("source", "sample")]
+        if ragged and all(is_ragged_statistic(df, c) for c in columns):
+            for column in columns:
+                write_ragged(df, column, f"{statistics_path}/{column}{RAGGED_SUFFIX}")
+                saved.append(f"{column}{RAGGED_SUFFIX}")
+            continue
+        df.to_pickle(f"{statistics_path}/{stat_name}.pkl")
+        saved.append(f"{stat_name}.pkl")
+    return saved
 
 
 def main():
@@ -45,32 +216,56 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-dir", "--data_type", type=str, default="in_silico")
     parser.add_argument("-time", "--time", type=int, default=72)
-    parser.add_argument("-stat", "--statistic", type=str, default=None)
+    parser.add_argument("-stat", "--statistic", type=str, nargs="+", default=None)
     parser.add_argument("-source", "--source", type=str, default=None)
     parser.add_argument("-sample", "--sample", type=str, default=None)
+    parser.add_argument("-workers", "--workers", type=int, default=1)
+    parser.add_argument("-store", "--store", action="store_true")
+    parser.add_argument("-cache", "--cache", action="store_true")
+    parser.add_argument("-cache_mb", "--cache_mb", type=float, default=None)
+    parser.add_argument("-samples", "--samples", type=str, default=None)
+    parser.add_argument("-ragged", "--ragged", action="store_true")
+    parser.add_argument("-ledger", "--ledger", action="store_true")
     args = parser.parse_args()
 
-    processed_path = get_data_path(args.data_type, "processed", args.time)
-    stat_name = args.statistic
-    print(stat_name)
+    if args.store:
+        data_path = get_data_path(args.data_type, "store", args.time)
+    else:
+        data_path = get_data_path(args.data_type, "processed", args.time)
+    statistics = get_statistics(args.data_type, args.statistic)
+    print(" ".join(statistics))
+
+    individual = args.source is not None or args.sample is not None or args.samples is not None
+    if args.samples is not None:
+        samples_file = args.samples.replace("%a", os.environ.get("SLURM_ARRAY_TASK_ID", "%a"))
+        with open(samples_file, encoding="UTF-8") as f:
+            file_names = [line.rstrip("\n") for line in f if line.strip()]
+    elif individual:
+        file_names = [f"{args.source} {args.sample}.csv"]
+    else:
+        file_names = get_file_names(data_path, args.store)
+
+    cache = None
+    if args.cache:
+        cache = StatisticCache(get_data_path(args.data_type, "cache"))
 
-    stat_calculation = STATISTIC_REGISTRY[stat_name]
-    stat_args = get_statistic_calculation_arguments(args.data_type, stat_name)
+    ledger = None
+    if args.ledger:
+        ledger = RunLedger(f"{get_data_path(args.data_type, '.')}/{LEDGER_FILE}")
 
-    if args.source is None and args.sample is None:
+    dfs = calculate_statistics(data_path, file_names, statistics, args.workers, cache, ledger)
+    if not individual:
         statistics_path = get_data_path(args.data_type, "statistics", args.time)
-        save_loc = f"{statistics_path}/{stat_name}.pkl"
-        file_names = os.listdir(processed_path)
+        save_statistics(dfs, statistics_path, args.ragged)
     else:
-        statistics_path = get_data_path(args.data_type, f"statistics/{stat_name}", args.time)
-        save_loc = f"{statistics_path}/{args.source} {args.sample}.pkl"
-        file_names = [f"{args.source} {args.sample}.csv"]
+        for stat_name, df in dfs.items():
+            statistics_path = get_data_path(args.data_type, f"statistics/{stat_name}", args.time)
+            for i in range(len(df)):
+                row = df.iloc[[i]]
+                row.to_pickle(f"{statistics_path}/{row['source'].iloc[0]} {row['sample'].iloc[0]}.pkl")
 
-    df = calculate_statistics(
-        processed_path, file_names, stat_name, stat_calculation, stat_args
-    )
-    if len(df) > 0:
-        df.to_pickle(save_loc)
+    if cache is not None and args.cache_mb is not None:
+        cache.evict(args.cache_mb * 1e6)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+"""Convert processed sample csvs into a binary columnar store.
+
+The store is saved in data/{data_type}/{time}/store and can be read with
+processed_store. Coordinates are saved as int32 if every sample has integer
+coordinates that fit in int32 and as float64 otherwise, cell types are saved as uint8
+codes.
+
+Expected usage: python3 -m spatial_egt.data_processing.processed_to_store -dir data_type -time time
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_integer_dtype
+
+from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.processed_store import CELL_TYPES, META_FILE, SAMPLES_FILE
+
+
+def get_sample_file_names(processed_path):
+    """Sorted names of the "{source} {sample}.csv" files in processed_path"""
+    return sorted(
+        file_name for file_name in os.listdir(processed_path)
+        if file_name.endswith(".csv") and " " in file_name
+    )
+
+
+def fits_int32(values):
+    """If the parsed coordinates are integers that int32 holds exactly"""
+    if not is_integer_dtype(values.dtype):
+        return False
+    info = np.iinfo(np.int32)
+    return len(values) == 0 or (values.min() >= info.min and values.max() <= info.max)
+
+
+def downcast_coord_file(coord_path, chunk_size=2**22):
+    """Rewrite a float64 coordinate file as int32, chunk by chunk"""
+    if os.path.getsize(coord_path) == 0:
+        return
+    values = np.memmap(coord_path, dtype=np.float64, mode="r")
+    with open(f"{coord_path}.tmp", "wb") as f:
+        for start in range(0, len(values), chunk_size):
+            f.write(values[start:start + chunk_size].astype(np.int32).tobytes())
+    del values
+    os.replace(f"{coord_path}.tmp", coord_path)
+
+
+def convert(processed_path, store_path):
+    """Append each processed sample to the store's binary arrays
+
+    Each csv is parsed once. Coordinates are written as float64 and the files are
+    rewritten as int32 at the end if every parsed coordinate fit in int32.
+    """
+    file_names = get_sample_file_names(processed_path)
+    type_codes = {cell_type: i for i, cell_type in enumerate(CELL_TYPES)}
+    columns = None
+    coord_files = {}
+    integral = True
+    offsets = [0]
+    samples = []
+    with open(f"{store_path}/type.bin", "wb") as type_file:
+        for file_name in file_names:
+            df = pd.read_csv(f"{processed_path}/{file_name}")
+            sample_columns = [c for c in df.columns if c != "type"]
+            if columns is None:
+                columns = sample_columns
+                for column in columns:
+                    coord_files[column] = open(f"{store_path}/{column}.bin", "wb")
+            elif sample_columns != columns:
+                raise ValueError(f"{file_name} has columns {sample_columns}, expected {columns}")
+            types = df["type"].map(type_codes)
+            if types.isna().any():
+                raise ValueError(f"{file_name} has cell types other than {CELL_TYPES}")
+            for column in columns:
+                values = df[column].to_numpy()
+                integral &= fits_int32(values)
+                coord_files[column].write(values.astype(np.float64).tobytes())
+            type_file.write(types.to_numpy(dtype=np.uint8).tobytes())
+            offsets.append(offsets[-1] + len(df))
+            samples.append(file_name[:-4].split(" ", 1))
+    for coord_file in coord_files.values():
+        coord_file.close()
+    coord_dtype = "int32" if integral else "float64"
+    if coord_dtype == "int32":
+        for column in coord_files:
+            downcast_coord_file(f"{store_path}/{column}.bin")
+
+    np.asarray(offsets, dtype=np.int64).tofile(f"{store_path}/offsets.bin")
+    pd.DataFrame(samples, columns=["source", "sample"]).to_csv(
+        f"{store_path}/{SAMPLES_FILE}", index=False
+    )
+    meta = {"columns": columns or [], "coord_dtype": coord_dtype, "num_cells": offsets[-1]}
+    with open(f"{store_path}/{META_FILE}", "w", encoding="UTF-8") as f:
+        json.dump(meta, f)
+
+
+def main():
+    """Convert processed csvs into a store"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--data_type", type=str, default="in_silico")
+    parser.add_argument("-time", "--time", type=int, default=72)
+    args = parser.parse_args()
+
+    processed_path = get_data_path(args.data_type, "processed", args.time)
+    store_path = get_data_path(args.data_type, "store", args.time)
+    convert(processed_path, store_path)
+
+
+if __name__ == "__main__":
+    main()
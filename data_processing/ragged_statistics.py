@@ -0,0 +1,122 @@
+"""Ragged on-disk format for distribution and function statistics.
+
+A ragged statistic is saved as the directory data/{data_type}/{time}/statistics/{name}.ragged
+holding the concatenation of every sample's values (values.npy), the offsets of each
+sample within them (offsets.npy), and the source and sample of each row (keys.csv).
+The arrays are memory-mapped when read, so a single sample can be accessed without
+loading the whole statistic.
+
+Expected usage to convert existing pkls:
+python3 -m spatial_egt.data_processing.ragged_statistics -dir data_type -time time -stat names
+
+Where:
+-stat: the statistics to convert, "all" converts every distribution or function pkl
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_object_dtype
+
+from spatial_egt.common import get_data_path
+
+
+RAGGED_SUFFIX = ".ragged"
+
+
+def flatten_statistic(values):
+    """Flatten per-sample arrays into one array and the offsets of each sample in it"""
+    lengths = np.fromiter((len(value) for value in values), dtype=np.int64, count=len(values))
+    offsets = np.zeros(len(values)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if offsets[-1] == 0:
+        return np.empty(0), offsets
+    flat = np.concatenate([np.asarray(value, dtype=float).ravel() for value in values])
+    return flat, offsets
+
+
+def is_ragged_statistic(df, stat_name):
+    """Check if a statistic's values are per-sample arrays"""
+    return is_object_dtype(df[stat_name])
+
+
+def write_ragged(df, stat_name, save_loc):
+    """Save the stat_name column of df as a ragged statistic in the directory save_loc"""
+    os.makedirs(save_loc, exist_ok=True)
+    flat, offsets = flatten_statistic(df[stat_name].values)
+    np.save(f"{save_loc}/values.npy", flat)
+    np.save(f"{save_loc}/offsets.npy", offsets)
+    keys = df[["source", "sample"]].astype(str)
+    keys.to_csv(f"{save_loc}/keys.csv", index=False)
+
+
+class RaggedStatistic:
+    """Memory-mapped ragged statistic"""
+
+    def __init__(self, save_loc, stat_name):
+        self.name = stat_name
+        self.values = np.load(f"{save_loc}/values.npy", mmap_mode="r")
+        self.offsets = np.load(f"{save_loc}/offsets.npy", mmap_mode="r")
+        self.keys = pd.read_csv(f"{save_loc}/keys.csv", dtype=str)
+        self.index = {
+            (source, sample): i for i, (source, sample) in enumerate(self.keys.values)
+        }
+
+    def __len__(self):
+        return len(self.keys)
+
+    def sample(self, i):
+        """View of the ith row's values"""
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def rows(self, source="", sample_ids=None):
+        """Row numbers of the samples from source (all if "") and in sample_ids (all if None)"""
+        mask = np.ones(len(self), dtype=bool)
+        if source != "":
+            mask &= (self.keys["source"] == source).values
+        if sample_ids:
+            mask &= self.keys["sample"].isin(sample_ids).values
+        return np.flatnonzero(mask)
+
+    def to_frame(self, rows=None):
+        """DataFrame in the pkl layout, with each row's values as a view of the store"""
+        if rows is None:
+            rows = range(len(self))
+        df = self.keys.iloc[list(rows)].reset_index(drop=True)
+        df[self.name] = pd.Series([self.sample(i) for i in rows], dtype=object)
+        return df
+
+
+def read_ragged(statistics_path, stat_name):
+    """Open the ragged statistic stat_name saved in statistics_path"""
+    return RaggedStatistic(f"{statistics_path}/{stat_name}{RAGGED_SUFFIX}", stat_name)
+
+
+def ragged_exists(statistics_path, stat_name):
+    """Check if stat_name has been saved as a ragged statistic"""
+    return os.path.exists(f"{statistics_path}/{stat_name}{RAGGED_SUFFIX}/offsets.npy")
+
+
+def main():
+    """Convert distribution and function statistic pkls into ragged statistics"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--data_type", type=str, default="in_silico")
+    parser.add_argument("-time", "--time", type=int, default=72)
+    parser.add_argument("-stat", "--statistic", type=str, nargs="+", default=["all"])
+    args = parser.parse_args()
+
+    statistics_path = get_data_path(args.data_type, "statistics", args.time)
+    if args.statistic == ["all"]:
+        stat_names = [f[:-4] for f in os.listdir(statistics_path) if f.endswith(".pkl")]
+    else:
+        stat_names = args.statistic
+    for stat_name in stat_names:
+        df = pd.read_pickle(f"{statistics_path}/{stat_name}.pkl")
+        if is_ragged_statistic(df, stat_name):
+            write_ragged(df, stat_name, f"{statistics_path}/{stat_name}{RAGGED_SUFFIX}")
+
+
+if __name__ == "__main__":
+    main()
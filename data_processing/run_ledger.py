@@ -0,0 +1,165 @@
+"""Append-only ledger of the cost of each statistic calculated on each sample.
+
+Each calculation appends one JSON line to data/{data_type}/ledger.jsonl with the run id,
+statistic, source, sample, number of cells, wall and CPU seconds, how much the
+calculation raised the peak resident memory of the process and that peak after it
+(in MB), if it succeeded, and if the result came from the statistic cache. The peak is
+of the whole process, so in a sample-major run every statistic after the most memory
+hungry one records the same process peak, and only a statistic that set a new peak
+has a rss_growth_mb above 0. Workers append their own lines, each in a single write.
+
+Expected usage to report on the ledger:
+python3 -m spatial_egt.data_processing.run_ledger -dir data_type (-run run_id) (-costs stat file)
+
+Where:
+-run: only report on the given run, all runs by default
+-costs: save the mean seconds of each sample of the statistic to the file, for
+    write_statistics_bash -costs
+"""
+
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from spatial_egt.common import get_data_path
+
+
+LEDGER_FILE = "ledger.jsonl"
+
+
+def get_peak_rss():
+    """Peak resident memory of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class RunLedger:
+    """Ledger file that one run appends its records to"""
+
+    def __init__(self, ledger_path, run_id=None):
+        self.path = ledger_path
+        self.run_id = run_id if run_id is not None else time.strftime("%Y%m%d-%H%M%S")
+
+    def append(self, **record):
+        line = json.dumps({"run": self.run_id, "time": time.time()} | record) + "\n"
+        with open(self.path, "a", encoding="UTF-8") as f:
+            f.write(line)
+
+    @contextmanager
+    def measure(self, stat_name, source, sample, cells):
+        """Record the cost of the calculation run in the with block
+
+        Exceptions are recorded as a failure and raised again.
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        peak_start = get_peak_rss()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            peak = get_peak_rss()
+            self.append(statistic=stat_name, source=source, sample=sample, cells=cells,
+                        wall=time.perf_counter() - wall_start, cpu=time.process_time() - cpu_start,
+                        rss_growth_mb=peak - peak_start, process_peak_rss_mb=peak,
+                        success=success, cached=False)
+
+    def record_cached(self, stat_name, source, sample):
+        self.append(statistic=stat_name, source=source, sample=sample, cells=None,
+                    wall=0.0, cpu=0.0, rss_growth_mb=None, process_peak_rss_mb=None,
+                    success=True, cached=True)
+
+
+def read_ledger(ledger_path):
+    """DataFrame of every record in the ledger
+
+    Older records named the process peak peak_rss_mb and have no rss_growth_mb.
+    """
+    df = pd.read_json(ledger_path, lines=True, dtype={"source": str, "sample": str})
+    for column in ["rss_growth_mb", "process_peak_rss_mb"]:
+        if column not in df:
+            df[column] = np.nan
+    if "peak_rss_mb" in df:
+        df["process_peak_rss_mb"] = df["process_peak_rss_mb"].fillna(df.pop("peak_rss_mb"))
+    return df
+
+
+def fit_cost(cells, seconds):
+    """Fit seconds = a * cells^b on the log scale, returning (a, b)"""
+    keep = (cells > 0) & (seconds > 0)
+    if np.sum(keep) < 2 or len(np.unique(cells[keep])) < 2:
+        return np.nan, np.nan
+    b, log_a = np.polyfit(np.log(cells[keep]), np.log(seconds[keep]), 1)
+    return np.exp(log_a), b
+
+
+def cost_report(df):
+    """Cost of each statistic, ranked by total wall time
+
+    Includes the fit of wall time against number of cells, where an exponent of 1
+    means the statistic scales linearly with the sample size.
+    """
+    calculated = df[~df["cached"]]
+    rows = []
+    for stat_name, df_stat in calculated.groupby("statistic"):
+        succeeded = df_stat[df_stat["success"]]
+        a, b = fit_cost(succeeded["cells"].values.astype(float), succeeded["wall"].values)
+        rows.append({
+            "statistic": stat_name,
+            "samples": len(df_stat),
+            "failures": int((~df_stat["success"]).sum()),
+            "cached": int(((df["statistic"] == stat_name) & df["cached"]).sum()),
+            "total_wall": df_stat["wall"].sum(),
+            "total_cpu": df_stat["cpu"].sum(),
+            "mean_wall": df_stat["wall"].mean(),
+            "max_wall": df_stat["wall"].max(),
+            "max_rss_growth_mb": df_stat["rss_growth_mb"].max(),
+            "process_peak_rss_mb": df_stat["process_peak_rss_mb"].max(),
+            "cost_coefficient": a,
+            "cost_exponent": b,
+        })
+    report = pd.DataFrame(rows)
+    if len(report) == 0:
+        return report
+    report["share"] = report["total_wall"] / report["total_wall"].sum()
+    return report.sort_values("total_wall", ascending=False).reset_index(drop=True)
+
+
+def sample_costs(df, stat_name):
+    """Mean wall time of each sample of a statistic, in the format of write_statistics_bash -costs"""
+    df = df[(df["statistic"] == stat_name) & df["success"] & ~df["cached"]]
+    df = df.groupby(["source", "sample"], as_index=False)["wall"].mean()
+    return df.rename(columns={"wall": "seconds"})
+
+
+def main():
+    """Report the cost of each statistic in the ledger"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--data_type", type=str, default="in_silico")
+    parser.add_argument("-run", "--run", type=str, default=None)
+    parser.add_argument("-costs", "--costs", type=str, nargs=2, default=None)
+    args = parser.parse_args()
+
+    ledger_path = f"{get_data_path(args.data_type, '.')}/{LEDGER_FILE}"
+    if not os.path.exists(ledger_path):
+        print(f"No ledger at {ledger_path}")
+        return
+    df = read_ledger(ledger_path)
+    if args.run is not None:
+        df = df[df["run"].astype(str) == args.run]
+    if args.costs is not None:
+        sample_costs(df, args.costs[0]).to_csv(args.costs[1], index=False)
+    with pd.option_context("display.max_columns", None, "display.width", None):
+        print(cost_report(df).to_string(index=False, float_format="{:.4g}".format))
+
+
+if __name__ == "__main__":
+    main()
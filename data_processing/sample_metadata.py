@@ -0,0 +1,114 @@
+"""Indexed sample metadata read from labels.csv.
+
+labels.csv is read once per data type and kept in memory until the file is modified.
+Each sample gets an integer sample id (its row in labels.csv), source and sample are
+categorical keys, the payoffs a, b, c, d are float arrays, and game is categorical.
+Statistics and features are joined to the labels through the sample ids instead of
+merging on the string source and sample columns. A (source, sample) pair is looked up
+by the codes of its source and sample categories, combined into one integer key.
+Each sample can only be labeled once.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from spatial_egt.common import get_data_path
+
+
+LABELS_FILE = "labels.csv"
+PAYOFFS = ["a", "b", "c", "d"]
+
+_metadata_cache = {}
+
+
+class SampleMetadata:
+    """Labels of every sample of a data type, indexed by sample id"""
+
+    def __init__(self, df):
+        df = df.reset_index(drop=True)
+        df["source"] = df["source"].astype(str).astype("category")
+        df["sample"] = df["sample"].astype(str).astype("category")
+        for payoff in PAYOFFS:
+            if payoff in df:
+                df[payoff] = df[payoff].astype(float)
+        if "game" in df:
+            df["game"] = df["game"].astype("category")
+        df.index.name = "sample_id"
+        duplicated = df.duplicated(["source", "sample"])
+        if duplicated.any():
+            duplicates = [f"{s} {x}" for s, x in df.loc[duplicated, ["source", "sample"]].values]
+            raise ValueError(f"Samples labeled more than once: {', '.join(duplicates[:10])}")
+        self.df = df
+        keys = self.keys(df["source"].cat.codes.values, df["sample"].cat.codes.values)
+        self.key_order = np.argsort(keys)
+        self.sorted_keys = keys[self.key_order]
+
+    def __len__(self):
+        return len(self.df)
+
+    def keys(self, source_codes, sample_codes):
+        """Integer key of each pair of source and sample category codes"""
+        num_samples = len(self.df["sample"].cat.categories)
+        return source_codes.astype(np.int64)*num_samples + sample_codes
+
+    def ids(self, source, sample):
+        """Sample ids of the source, sample pairs, -1 for samples without labels"""
+        source_codes = pd.Categorical(np.asarray(source).astype(str),
+                                      categories=self.df["source"].cat.categories).codes
+        sample_codes = pd.Categorical(np.asarray(sample).astype(str),
+                                      categories=self.df["sample"].cat.categories).codes
+        keys = self.keys(source_codes, sample_codes)
+        if len(self) == 0:
+            return np.full(len(keys), -1)
+        positions = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self) - 1)
+        found = (source_codes >= 0) & (sample_codes >= 0) & (self.sorted_keys[positions] == keys)
+        return np.where(found, self.key_order[positions], -1)
+
+    def select(self, source=None, sample_ids=None):
+        """Sample ids of the samples from the source with the given sample names"""
+        keep = np.ones(len(self), dtype=bool)
+        if source:
+            keep &= (self.df["source"] == source).values
+        if sample_ids:
+            keep &= self.df["sample"].isin([str(s) for s in sample_ids]).values
+        return np.flatnonzero(keep)
+
+    def frame(self, columns=None, ids=None):
+        """Source, sample, and the label columns of the samples, indexed by sample id"""
+        df = self.df
+        if columns is not None:
+            df = df[["source", "sample"] + [c for c in columns if c not in ("source", "sample")]]
+        if ids is None:
+            return df.copy()
+        df = df.iloc[ids].copy()
+        categorical = df.select_dtypes("category").columns
+        df[categorical] = df[categorical].apply(lambda c: c.cat.remove_unused_categories())
+        return df
+
+    def index_by_id(self, df):
+        """DataFrame with source and sample columns indexed by sample id instead
+
+        Rows of samples without labels are dropped.
+        """
+        sample_ids = self.ids(df["source"], df["sample"])
+        df = df.drop(["source", "sample"], axis=1)
+        df.index = pd.Index(sample_ids, name="sample_id")
+        return df[sample_ids >= 0]
+
+    def join(self, df, columns=None, ids=None, how="inner"):
+        """Join the labels of the samples to a DataFrame with source and sample columns"""
+        return self.frame(columns, ids).join(self.index_by_id(df), how=how)
+
+
+def get_metadata(data_type):
+    """Sample metadata of the data type, read again only if labels.csv was modified"""
+    labels_path = f"{get_data_path(data_type, '.')}/{LABELS_FILE}"
+    mtime = os.stat(labels_path).st_mtime_ns
+    cached = _metadata_cache.get(labels_path)
+    if cached is None or cached[0] != mtime:
+        df = pd.read_csv(labels_path, dtype={"source": str, "sample": str})
+        cached = (mtime, SampleMetadata(df))
+        _metadata_cache[labels_path] = cached
+    return cached[1]
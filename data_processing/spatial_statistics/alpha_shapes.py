@@ -0,0 +1,85 @@
+"""Alpha shape patches from a Delaunay triangulation, without muspan.
+
+The alpha shape of a cell type is the union of the Delaunay triangles of its cells
+whose circumradius is below alpha. Patches are the groups of those triangles connected
+through shared edges. Patch areas are the sums of their triangle areas and patch
+perimeters the summed lengths of the edges on their boundary (including holes),
+giving circularity as 4*pi*area/perimeter^2.
+
+Selected with backend="fast" in the muspan_statistics patch statistics. The
+triangulation of each cell type is cached in the sample's context, so every alpha
+(and every patch statistic) calculated on a sample reuses it.
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import Delaunay, QhullError
+
+from spatial_egt.data_processing.spatial_statistics.sample_context import get_context
+
+
+class Triangulation:
+    """Delaunay triangles of a point set with their edge lengths, areas, and circumradii"""
+
+    def __init__(self, coords):
+        self.neighbors = np.empty((0, 3), dtype=int)
+        self.edge_lengths = np.empty((0, 3))
+        self.areas = np.empty(0)
+        self.circumradii = np.empty(0)
+        if len(coords) < 3:
+            return
+        try:
+            delaunay = Delaunay(coords)
+        except QhullError:
+            return  # all points are collinear
+        corners = coords[delaunay.simplices]
+        # edge k is opposite vertex k, matching the order of Delaunay.neighbors
+        self.edge_lengths = np.stack([
+            np.linalg.norm(corners[:, 2] - corners[:, 1], axis=1),
+            np.linalg.norm(corners[:, 0] - corners[:, 2], axis=1),
+            np.linalg.norm(corners[:, 1] - corners[:, 0], axis=1),
+        ], axis=1)
+        side1 = corners[:, 1] - corners[:, 0]
+        side2 = corners[:, 2] - corners[:, 0]
+        self.areas = np.abs(side1[:, 0]*side2[:, 1] - side1[:, 1]*side2[:, 0]) / 2
+        with np.errstate(divide="ignore"):
+            self.circumradii = np.prod(self.edge_lengths, axis=1) / (4*self.areas)
+        self.neighbors = delaunay.neighbors
+
+    def patches(self, alpha):
+        """Areas and perimeters of the alpha shape's patches"""
+        kept = self.circumradii < alpha
+        kept_ids = np.flatnonzero(kept)
+        if len(kept_ids) == 0:
+            return np.empty(0), np.empty(0)
+        neighbors = self.neighbors[kept_ids]
+        neighbor_kept = (neighbors >= 0) & kept[np.maximum(neighbors, 0)]
+
+        # label patches as the connected components of kept triangles sharing an edge
+        local_id = np.full(len(kept), -1)
+        local_id[kept_ids] = np.arange(len(kept_ids))
+        rows = np.repeat(np.arange(len(kept_ids)), 3)[neighbor_kept.ravel()]
+        cols = local_id[neighbors[neighbor_kept]]
+        adjacency = coo_matrix((np.ones(len(rows)), (rows, cols)),
+                               shape=(len(kept_ids), len(kept_ids)))
+        num_patches, labels = connected_components(adjacency, directed=False)
+
+        boundary_lengths = np.where(neighbor_kept, 0, self.edge_lengths[kept_ids]).sum(axis=1)
+        areas = np.bincount(labels, weights=self.areas[kept_ids], minlength=num_patches)
+        perimeters = np.bincount(labels, weights=boundary_lengths, minlength=num_patches)
+        return areas, perimeters
+
+
+def get_triangulation(df, cell_type):
+    """Triangulation of the cells of cell_type, built once per sample"""
+    context = get_context(df)
+    return context.get(("triangulation", cell_type),
+                       lambda: Triangulation(context.coords(cell_type, ("x", "y"))))
+
+
+def alpha_shape_patches(df, cell_type, alpha):
+    """Number, areas and circularities of the alpha shape patches of cell_type"""
+    areas, perimeters = get_triangulation(df, cell_type).patches(alpha)
+    circularities = 4*np.pi*areas / perimeters**2
+    return len(areas), areas, circularities
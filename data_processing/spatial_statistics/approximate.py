@@ -0,0 +1,185 @@
+"""Budgeted approximations of the point pattern statistics with bootstrap confidence intervals.
+
+Instead of every cell, at most budget focal cells (or random probe points, for the
+empty space part of the J-function) are sampled, and each contributes its own
+term of the estimator: its edge corrected neighbour counts for cross-K and the pair
+correlation function, or its nearest neighbour distance. The estimate is the mean
+over the sampled points, and its confidence interval is from bootstrap resampling
+of those points. The number of focal points sampled is returned as the budget.
+
+approx_cross_k, approx_cpcf, and approx_nn_dist approximate the backend="fast"
+statistics of the same name on the same arguments. approx_j_function is a different
+estimator from muspan's J-function: it has its own radii and no edge correction, so
+its values are not comparable to j_function's on the same sample.
+
+The statistics return an Approximation, which processed_to_statistic saves as the
+columns {statistic}, {statistic}_lower, {statistic}_upper, and {statistic}_budget.
+Features of these statistics are named {feature}_Approx (see statistics_to_features).
+"""
+
+import numpy as np
+
+from spatial_egt.data_processing.spatial_statistics import point_pattern as pp
+
+
+APPROXIMATION_SUFFIXES = ("_lower", "_upper", "_budget")
+
+
+class Approximation:
+    """Estimate of a statistic with the bounds of its confidence interval"""
+
+    def __init__(self, estimate, lower, upper, budget):
+        self.estimate = estimate
+        self.lower = lower
+        self.upper = upper
+        self.budget = budget
+
+    def columns(self, name):
+        """The estimate, bounds, and budget under their column names"""
+        return {name: self.estimate, f"{name}_lower": self.lower,
+                f"{name}_upper": self.upper, f"{name}_budget": self.budget}
+
+
+def sample_points(num_points, budget, rng):
+    """Indices of at most budget of num_points, without replacement"""
+    if num_points <= budget:
+        return np.arange(num_points)
+    return np.sort(rng.choice(num_points, size=budget, replace=False))
+
+
+def bootstrap_means(terms, bootstraps, rng):
+    """Means of the rows of terms over bootstrap resamples of the rows"""
+    num_terms = len(terms)
+    resample_counts = rng.multinomial(num_terms, np.full(num_terms, 1/num_terms), size=bootstraps)
+    return resample_counts @ terms / num_terms
+
+
+def confidence_interval(bootstrapped, confidence):
+    tail = (1 - confidence) / 2 * 100
+    return np.percentile(bootstrapped, [tail, 100 - tail], axis=0)
+
+
+def focal_pair_terms(df, cell_type1, cell_type2, max_radius, budget, rng):
+    """Sampled focal cells' edge corrected neighbour distances
+
+    :return: the number of sampled cells, the index of the sampled cell of each pair,
+        the pairs' distances and weights, and the number of other cells each focal cell
+        can be paired with (n2, or n2 - 1 within one population, see pp.num_pairs)
+    """
+    focal_tree = pp.get_tree(df, cell_type1)
+    other_tree = pp.get_tree(df, cell_type2)
+    sampled = sample_points(focal_tree.n, budget, rng)
+    focal_points = focal_tree.data[sampled]
+    neighbors = other_tree.query_ball_point(focal_points, max_radius)
+    focal = np.repeat(np.arange(len(sampled)), [len(n) for n in neighbors])
+    others = np.fromiter((j for n in neighbors for j in n), dtype=int, count=len(focal))
+    if cell_type1 == cell_type2:
+        keep = sampled[focal] != others
+        focal, others = focal[keep], others[keep]
+    distances = np.linalg.norm(other_tree.data[others] - focal_points[focal], axis=1)
+    weights = pp.isotropic_edge_weights(focal_points[focal], distances, pp.get_bounds(df))
+    num_others = other_tree.n - 1 if cell_type1 == cell_type2 else other_tree.n
+    return len(sampled), focal, distances, weights, num_others
+
+
+def approx_cross_k(df, max_radius, step, cell_type1="sensitive", cell_type2="resistant",
+                   budget=1000, bootstraps=200, confidence=0.95, seed=None):
+    """cross_k (backend="fast") estimated from at most budget focal cells"""
+    rng = np.random.default_rng(seed)
+    radii = pp.get_radii(max_radius, step)
+    num_sampled, focal, distances, weights, num_others = focal_pair_terms(
+        df, cell_type1, cell_type2, max_radius, budget, rng
+    )
+    if num_sampled == 0 or num_others <= 0:
+        nan = np.full(len(radii) - 1, np.nan)
+        return Approximation(nan, nan, nan, num_sampled)
+    radius_bin = np.searchsorted(radii, distances, side="left")
+    counts = np.zeros((num_sampled, len(radii)))
+    np.add.at(counts, (focal, radius_bin), weights)
+    terms = pp.get_area(pp.get_bounds(df)) / num_others * np.cumsum(counts, axis=1)[:, 1:]
+    lower, upper = confidence_interval(bootstrap_means(terms, bootstraps, rng), confidence)
+    return Approximation(terms.mean(axis=0), lower, upper, num_sampled)
+
+
+def approx_cpcf(df, max_radius, annulus_step, annulus_width, cell_type1="sensitive",
+                cell_type2="resistant", budget=1000, bootstraps=200, confidence=0.95, seed=None):
+    """cpcf (backend="fast") estimated from at most budget focal cells"""
+    rng = np.random.default_rng(seed)
+    radii = pp.get_radii(max_radius, annulus_step)
+    inner = np.maximum(radii - annulus_width/2, 0)
+    outer = radii + annulus_width/2
+    num_sampled, focal, distances, weights, num_others = focal_pair_terms(
+        df, cell_type1, cell_type2, outer[-1], budget, rng
+    )
+    if num_sampled == 0 or num_others <= 0:
+        nan = np.full(len(radii), np.nan)
+        return Approximation(nan, nan, nan, num_sampled)
+    in_annulus = (distances[:, None] >= inner) & (distances[:, None] < outer)
+    counts = np.zeros((num_sampled, len(radii)))
+    np.add.at(counts, focal, in_annulus*weights[:, None])
+    density = num_others / pp.get_area(pp.get_bounds(df))
+    terms = counts / (density*np.pi*(outer**2 - inner**2))
+    lower, upper = confidence_interval(bootstrap_means(terms, bootstraps, rng), confidence)
+    return Approximation(terms.mean(axis=0), lower, upper, num_sampled)
+
+
+def approx_nn_dist(df, cell_type1="sensitive", cell_type2="resistant",
+                   budget=1000, bootstraps=200, confidence=0.95, seed=None):
+    """nn_dist (backend="fast") of at most budget focal cells
+
+    The bounds are the confidence interval of the mean nearest neighbour distance.
+    """
+    rng = np.random.default_rng(seed)
+    focal_tree = pp.get_tree(df, cell_type1)
+    other_tree = pp.get_tree(df, cell_type2)
+    sampled = sample_points(focal_tree.n, budget, rng)
+    if cell_type1 == cell_type2:
+        distances = other_tree.query(focal_tree.data[sampled], k=2)[0][:, 1]
+    else:
+        distances = other_tree.query(focal_tree.data[sampled])[0]
+    if len(distances) == 0:
+        return Approximation(distances, np.nan, np.nan, 0)
+    bootstrapped = bootstrap_means(distances[:, None], bootstraps, rng)[:, 0]
+    lower, upper = confidence_interval(bootstrapped, confidence)
+    return Approximation(distances, lower, upper, len(sampled))
+
+
+def approx_j_function(df, cell_type, radius_step, max_radius=None,
+                      budget=1000, bootstraps=200, confidence=0.95, seed=None):
+    """J-function (1 - G) / (1 - F) from at most budget cells and budget probe points
+
+    G is the nearest neighbour distance distribution of sampled cells of cell_type and
+    F is the distance from uniformly random probe points in the bounding box to the
+    nearest cell of cell_type. The radii go up to max_radius, by default a quarter of
+    the shorter side of the bounding box. Cells and probe points are resampled
+    separately for the confidence interval. The budget returned is the number of
+    sampled cells, budget probe points are always used.
+
+    This is not an approximation of muspan's J-function (j_function in
+    muspan_statistics): the radii are not muspan's and neither G nor F is edge
+    corrected, so distances near the edge of the bounding box are overestimated.
+    Its features are kept apart from j_function's by the _Approx suffix and the two
+    should not be compared or mixed.
+    """
+    rng = np.random.default_rng(seed)
+    lower_bound, upper_bound = pp.get_bounds(df)
+    if max_radius is None:
+        max_radius = np.min(upper_bound - lower_bound) / 4
+    radii = pp.get_radii(max_radius, radius_step)
+    tree = pp.get_tree(df, cell_type)
+    sampled = sample_points(tree.n, budget, rng)
+    if tree.n < 2:
+        nan = np.full(len(radii), np.nan)
+        return Approximation(nan, nan, nan, len(sampled))
+    nn_distances = tree.query(tree.data[sampled], k=2)[0][:, 1]
+    probes = rng.uniform(lower_bound, upper_bound, size=(budget, len(pp.DIMENSIONS)))
+    probe_distances = tree.query(probes)[0]
+
+    g_terms = (nn_distances[:, None] <= radii).astype(float)
+    f_terms = (probe_distances[:, None] <= radii).astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        j = (1 - g_terms.mean(axis=0)) / (1 - f_terms.mean(axis=0))
+        bootstrapped = ((1 - bootstrap_means(g_terms, bootstraps, rng))
+                        / (1 - bootstrap_means(f_terms, bootstraps, rng)))
+    lower, upper = confidence_interval(bootstrapped, confidence)
+    return Approximation(j, lower, upper, len(sampled))
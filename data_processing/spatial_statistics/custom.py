@@ -1,67 +1,172 @@
-from random import choices
+from itertools import product
 
 import numpy as np
-from scipy.spatial import KDTree
+
+from spatial_egt.data_processing.spatial_statistics.lattice import get_lattice
+from spatial_egt.data_processing.spatial_statistics.sample_context import get_context
 
 
 # Spatial Subsample
-def spatial_subsample_dist(df, sample_length, num_samples=1000, return_fs=True):
-    dimensions = list(df.drop("type", axis=1).columns)
-    s_coords = df[df["type"] == "sensitive"][dimensions].values
-    r_coords = df[df["type"] == "resistant"][dimensions].values
-    dims = range(len(dimensions))
-
-    max_dims = [max(np.max(s_coords[:, i]), np.max(r_coords[:, i])) for i in dims]
-    dim_vals = [choices(range(0, max_dims[i]-sample_length), k=num_samples) for i in dims]
-    fs_counts = []
-    fr_counts = []
-    for s in range(num_samples):
-        ld = [dim_vals[i][s] for i in dims]
-        ud = [ld[i]+sample_length for i in dims]
-        subset_s = [(s_coords[:, i] >= ld[i]) & (s_coords[:, i] <= ud[i]) for i in dims]
-        subset_s = np.sum(np.all(subset_s, axis=0))
-        subset_r = [(r_coords[:, i] >= ld[i]) & (r_coords[:, i] <= ud[i]) for i in dims]
-        subset_r = np.sum(np.all(subset_r, axis=0))
-        subset_total = subset_s + subset_r
-        if subset_total == 0:
-            continue
-        fs_counts.append(subset_s/subset_total)
-        fr_counts.append(subset_r/subset_total)
+def summed_area_table(coords, shape):
+    """Summed-area table of the number of cells at each integer coordinate
+
+    The table is zero padded in front of every axis, so table[u] is the number of
+    cells with coordinates below u in every dimension.
+    """
+    inside = np.all((coords >= 0) & (coords < shape), axis=1)
+    linear = np.ravel_multi_index(tuple(coords[inside].T), shape)
+    counts = np.bincount(linear, minlength=np.prod(shape)).reshape(shape)
+    table = np.pad(counts, [(1, 0)]*len(shape))
+    for axis in range(len(shape)):
+        table = np.cumsum(table, axis=axis)
+    return table
+
+
+def window_counts(table, lower, sample_length):
+    """Number of cells in each window [lower, lower+sample_length] (inclusive)
+
+    Every window is answered from the corners of the summed-area table by
+    inclusion-exclusion, with one vectorized gather per corner.
+    """
+    upper = lower + sample_length + 1
+    num_dims = lower.shape[1]
+    counts = np.zeros(len(lower), dtype=np.int64)
+    for corner in product((0, 1), repeat=num_dims):
+        index = tuple(upper[:, i] if c else lower[:, i] for i, c in enumerate(corner))
+        sign = (-1)**(num_dims - sum(corner))
+        counts += sign*table[index]
+    return counts
+
 
+def subsample_fractions(s_table, r_table, lower, sample_length, return_fs):
+    """Fraction of sensitive (or resistant) cells in each non-empty window"""
+    subset_s = window_counts(s_table, lower, sample_length)
+    subset_r = window_counts(r_table, lower, sample_length)
+    subset_total = subset_s + subset_r
+    keep = subset_total != 0
     if return_fs:
-        return fs_counts
-    return fr_counts
+        return (subset_s[keep] / subset_total[keep]).tolist()
+    return (subset_r[keep] / subset_total[keep]).tolist()
 
 
-# Neighborhood Composition
-def nc_dist(df, radius, return_fs=True):
+def spatial_subsample_dist(df, sample_length, num_samples=1000, return_fs=True, seed=None):
     dimensions = list(df.drop("type", axis=1).columns)
-    s_coords = df[df["type"] == "sensitive"][dimensions].values
-    r_coords = df[df["type"] == "resistant"][dimensions].values
-    all_coords = np.concatenate((s_coords, r_coords), axis=0)
-
-    s_stop = len(s_coords)
-    tree = KDTree(all_coords)
-    fs = []
-    fr = []
-    for p,point in enumerate(all_coords):
-        neighbor_indices = tree.query_ball_point(point, radius)
-        all_neighbors = len(neighbor_indices)-1
-        if p <= s_stop: #sensitive cell
-            r_neighbors = len([x for x in neighbor_indices if x > s_stop])
-            if all_neighbors != 0 and r_neighbors != 0:
-                fr.append(r_neighbors/all_neighbors)
-        else: #resistant cell
-            s_neighbors = len([x for x in neighbor_indices if x <= s_stop])
-            if all_neighbors != 0 and s_neighbors != 0:
-                fs.append(s_neighbors/all_neighbors)
+    lattice = get_lattice(df)
+    if lattice is not None:
+        # the lattice's tables start at its origin instead of zero
+        max_dims = lattice.upper
+        offset = -lattice.origin
+        s_table = lattice.summed_area_table("sensitive")
+        r_table = lattice.summed_area_table("resistant")
+    else:
+        coords = df[dimensions].values
+        if not np.issubdtype(coords.dtype, np.integer):
+            raise ValueError("Spatial subsampling requires integer coordinates.")
+        s_coords = coords[(df["type"] == "sensitive").values]
+        r_coords = coords[(df["type"] == "resistant").values]
+        max_dims = np.max(coords, axis=0)
+        offset = 0
+        shape = tuple(max_dims + 1)
+        s_table = summed_area_table(s_coords, shape)
+        r_table = summed_area_table(r_coords, shape)
+
+    rng = np.random.default_rng(seed)
+    sample_lengths = sample_length if isinstance(sample_length, list) else [sample_length]
+    fractions = {}
+    for length in sample_lengths:
+        lower = rng.integers(0, max_dims - length, size=(num_samples, len(dimensions)))
+        fractions[length] = subsample_fractions(s_table, r_table, lower + offset, length, return_fs)
+
+    if isinstance(sample_length, list):
+        return fractions
+    return fractions[sample_length]
+
+
+# the tables do not depend on the window size, so a sweep reuses them for every size
+spatial_subsample_dist.sweep_params = ("sample_length",)
+
 
+# Neighborhood Composition
+def neighbor_type_counts(points, type_trees, radius):
+    """Count the cells of each type (columns) within radius of each point (rows)
+
+    Each type's cells have their own KDTree, which counts the neighbors of all points
+    in one batched query. Points that are themselves cells count themselves.
+    """
+    counts = np.zeros((len(points), len(type_trees)), dtype=int)
+    for t, tree in enumerate(type_trees):
+        if tree.n > 0:
+            counts[:, t] = tree.query_ball_point(points, radius, return_length=True)
+    return counts
+
+
+def neighbor_type_counts_by_radius(focal_tree, type_trees, radii):
+    """Count the cells of each type within each radius of each focal point
+
+    The neighbors are queried once at the largest radius and binned by distance,
+    so the counts of every radius come from a single pair query per type.
+    :return: counts of shape (focal points, types, radii)
+    """
+    radii = np.sort(radii)
+    counts = np.zeros((focal_tree.n, len(type_trees), len(radii)), dtype=int)
+    for t, tree in enumerate(type_trees):
+        if focal_tree.n == 0 or tree.n == 0:
+            continue
+        pairs = focal_tree.sparse_distance_matrix(tree, radii[-1], output_type="ndarray")
+        radius_bin = np.searchsorted(radii, pairs["v"], side="left")
+        binned = np.bincount(pairs["i"]*len(radii) + radius_bin,
+                             minlength=focal_tree.n*len(radii))
+        counts[:, t, :] = np.cumsum(binned.reshape(focal_tree.n, len(radii)), axis=1)
+    return counts
+
+
+def neighborhood_fractions(counts):
+    """Fraction of other type neighbors of each focal cell
+
+    counts has columns (focal type cells including the focal cell, other type cells),
+    cells without neighbors or without other type neighbors are skipped.
+    """
+    all_neighbors = counts.sum(axis=1) - 1
+    other_neighbors = counts[:, 1]
+    keep = (all_neighbors != 0) & (other_neighbors != 0)
+    return (other_neighbors[keep] / all_neighbors[keep]).tolist()
+
+
+def nc_dist(df, radius, return_fs=True):
+    context = get_context(df)
     if return_fs:
-        return fs
-    return fr
+        # fraction of sensitive neighbors around resistant cells
+        focal_type, other_type = "resistant", "sensitive"
+    else:
+        # fraction of resistant neighbors around sensitive cells
+        focal_type, other_type = "sensitive", "resistant"
+    lattice = get_lattice(df)
+    if lattice is not None:
+        # integer coordinates, count neighbors by convolving the lattice
+        def counts(r):
+            return lattice.neighbor_type_counts(focal_type, [focal_type, other_type], r)
+        if not isinstance(radius, list):
+            return neighborhood_fractions(counts(radius))
+        return {r: neighborhood_fractions(counts(r)) for r in sorted(radius)}
+
+    type_trees = [context.tree(focal_type), context.tree(other_type)]
+    if not isinstance(radius, list):
+        counts = neighbor_type_counts(context.coords(focal_type), type_trees, radius)
+        return neighborhood_fractions(counts)
+    counts = neighbor_type_counts_by_radius(context.tree(focal_type), type_trees, radius)
+    return {r: neighborhood_fractions(counts[:, :, k]) for k, r in enumerate(sorted(radius))}
+
+
+nc_dist.sweep_params = ("radius",)
 
 
 def proportion_cell(df, cell_type):
+    lattice = get_context(df).peek("lattice")
+    if lattice is not None:
+        # use the lattice's counts if it was already built (e.g. kept up to date over time)
+        num_sensitive = lattice.num_cells("sensitive")
+        num_resistant = lattice.num_cells("resistant")
+        return lattice.num_cells(cell_type)/(num_sensitive+num_resistant)
     num_sensitive = len(df[df["type"] == "sensitive"])
     num_resistant = len(df[df["type"] == "resistant"])
     if cell_type == "sensitive":
@@ -71,4 +176,7 @@ def proportion_cell(df, cell_type):
 
 
 def num_cell(df, cell_type):
+    lattice = get_context(df).peek("lattice")
+    if lattice is not None:
+        return lattice.num_cells(cell_type)
     return len(df[df["type"] == cell_type])
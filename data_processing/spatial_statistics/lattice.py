@@ -0,0 +1,334 @@
+"""Dense lattice representation of samples with integer coordinates.
+
+Agent-based model samples place cells on an integer grid. For these samples the cells
+of each type are rasterized once into a dense array of counts per grid site, and
+statistics that count cells in regions are calculated from whole-grid array operations
+instead of per-cell tree queries:
+
+- neighbor counts within a radius are a convolution of the counts with a disk kernel
+- window counts are read from a summed-area table of the counts
+- quadrat counts are block sums of the counts
+- cross-K and pair correlation functions are binned from the FFT cross-correlation
+  of the two types' counts over the x-y plane
+
+The lattice is built once per sample in the sample's context and is selected
+automatically (see get_lattice) when all coordinates are integral and the grid is
+not too sparse to be worth rasterizing.
+"""
+
+import numpy as np
+from scipy.signal import correlate, fftconvolve
+
+from spatial_egt.data_processing.spatial_statistics import point_pattern as pp
+from spatial_egt.data_processing.spatial_statistics.sample_context import get_context
+
+
+CELL_TYPES = ("sensitive", "resistant")
+# samples whose bounding box has more sites than this are left to the point based methods
+MAX_LATTICE_SITES = 2**24
+# as are samples with fewer cells per site, e.g. sparse cells at pixel coordinates
+MIN_LATTICE_DENSITY = 0.01
+
+
+def block_sums(counts, block_size):
+    """Sums of counts over blocks of block_size along every axis, the last blocks cut short"""
+    num_blocks = -(-np.array(counts.shape) // block_size)
+    padding = [(0, n*block_size - s) for n, s in zip(num_blocks, counts.shape)]
+    counts = np.pad(counts, padding)
+    block_shape = [v for n in num_blocks for v in (n, block_size)]
+    block_axes = tuple(range(1, 2*len(num_blocks), 2))
+    return counts.reshape(block_shape).sum(axis=block_axes)
+
+
+def disk_kernel(radius, num_dims):
+    """Offsets within radius of the origin, as a 0/1 array centered at the origin"""
+    reach = int(np.floor(radius))
+    axes = np.ogrid[tuple(slice(-reach, reach + 1) for _ in range(num_dims))]
+    squared_distances = sum(axis**2 for axis in axes)
+    return (squared_distances <= radius**2).astype(float)
+
+
+class Lattice:
+    """Number of cells of each type at each integer grid site of a sample
+
+    The grid starts at the lower bound of the coordinates or at zero, whichever is
+    lower, so for non-negative coordinates grid indices are the coordinates themselves.
+    """
+
+    def __init__(self, type_coords):
+        all_coords = np.concatenate(list(type_coords.values()))
+        self.lower = all_coords.min(axis=0)
+        self.upper = all_coords.max(axis=0)
+        self.origin = np.minimum(self.lower, 0)
+        self.shape = tuple(self.upper - self.origin + 1)
+        self.indices = {}
+        self.counts = {}
+        for cell_type, coords in type_coords.items():
+            indices = coords - self.origin
+            linear = np.ravel_multi_index(tuple(indices.T), self.shape)
+            counts = np.bincount(linear, minlength=np.prod(self.shape)).reshape(self.shape)
+            self.indices[cell_type] = indices
+            self.counts[cell_type] = counts
+        self.cache = {}
+
+    def _get(self, key, build):
+        if key not in self.cache:
+            self.cache[key] = build()
+        return self.cache[key]
+
+    def neighbor_counts(self, cell_type, radius):
+        """Number of cell_type cells within radius of each grid site (including the site)"""
+        def build():
+            kernel = disk_kernel(radius, len(self.shape))
+            counts = fftconvolve(self.counts[cell_type], kernel, mode="same")
+            return np.rint(counts).astype(int)
+        return self._get(("neighbor counts", cell_type, radius), build)
+
+    def neighbor_type_counts(self, focal_type, cell_types, radius):
+        """Count the cells of each type (columns) within radius of each focal_type cell (rows)"""
+        focal_sites = tuple(self.indices[focal_type].T)
+        counts = np.zeros((len(self.indices[focal_type]), len(cell_types)), dtype=int)
+        for t, cell_type in enumerate(cell_types):
+            counts[:, t] = self.neighbor_counts(cell_type, radius)[focal_sites]
+        return counts
+
+    def summed_area_table(self, cell_type):
+        """Summed-area table of the counts, zero padded in front of every axis"""
+        def build():
+            table = np.pad(self.counts[cell_type], [(1, 0)]*len(self.shape))
+            for axis in range(len(self.shape)):
+                table = np.cumsum(table, axis=axis)
+            return table
+        return self._get(("summed area table", cell_type), build)
+
+    def quadrat_shape(self, side_length):
+        """Number of quadrats along each axis of a grid starting at the lower bound"""
+        return tuple(-(-(np.array(self.shape) - (self.lower - self.origin)) // side_length))
+
+    def quadrat_counts(self, cell_type, side_length, base_side_length=None):
+        """Number of cell_type cells in each quadrat of a grid starting at the lower bound
+
+        Quadrats are side_length sites wide, the last quadrat of each axis is cut
+        at the end of the grid. Returns the counts flattened over quadrats.
+        If base_side_length divides side_length, the counts are summed from the
+        (cached) finer quadrats of base_side_length instead of from the sites, so a
+        sweep of side lengths rasterizes the sample into quadrats once.
+        """
+        def build():
+            if base_side_length is None or base_side_length == side_length:
+                start = self.lower - self.origin
+                counts = self.counts[cell_type][tuple(slice(s, None) for s in start)]
+                return block_sums(counts, side_length).ravel()
+            if side_length % base_side_length != 0:
+                raise ValueError(f"{base_side_length} does not divide {side_length}.")
+            base_counts = self.quadrat_counts(cell_type, base_side_length)
+            base_counts = base_counts.reshape(self.quadrat_shape(base_side_length))
+            return block_sums(base_counts, side_length // base_side_length).ravel()
+        return self._get(("quadrat counts", cell_type, side_length), build)
+
+    def plane_counts(self, cell_type):
+        """Counts over the x-y plane of the bounding box (summed over any other axes)
+
+        The grid of an IncrementalLattice can extend past the current bounding box,
+        so the counts are cropped to it on every side.
+        """
+        window = tuple(slice(l, u + 1) for l, u in zip(self.lower - self.origin,
+                                                      self.upper - self.origin))
+        counts = self.counts[cell_type][window]
+        return counts.sum(axis=tuple(range(2, counts.ndim)))
+
+    def weighted_pair_displacements(self, cell_type1, cell_type2, max_radius):
+        """Distances of the displacements between (cell_type1, cell_type2) pairs within max_radius
+
+        The number of pairs at every displacement is the cross-correlation of the two
+        types' counts, computed for all displacements at once with the FFT. Each
+        displacement's count is weighted by the translation edge correction, the
+        number of sites in the window over the number of sites that remain in the
+        window when shifted by the displacement. Distances are sorted.
+        :return: distances, number of pairs, and edge correction weights
+        """
+        def build():
+            counts1 = self.plane_counts(cell_type1)
+            counts2 = self.plane_counts(cell_type2)
+            pair_counts = correlate(counts2, counts1, mode="full", method="fft")
+            reach = [min(int(np.floor(max_radius)), s - 1) for s in counts1.shape]
+            center = [s - 1 for s in counts1.shape]
+            pair_counts = pair_counts[tuple(slice(c - r, c + r + 1) for c, r in zip(center, reach))]
+            pair_counts = np.rint(pair_counts)
+            if cell_type1 == cell_type2:
+                pair_counts[tuple(reach)] -= counts1.sum()  # cells paired with themselves
+
+            dx, dy = np.ogrid[tuple(slice(-r, r + 1) for r in reach)]
+            distances = np.sqrt(dx**2 + dy**2)
+            overlap = (counts1.shape[0] - np.abs(dx)) * (counts1.shape[1] - np.abs(dy))
+            weights = np.broadcast_to(counts1.size / overlap, distances.shape)
+            keep = (distances <= max_radius) & (pair_counts > 0)
+            distances, pair_counts, weights = distances[keep], pair_counts[keep], weights[keep]
+            order = np.argsort(distances)
+            return distances[order], pair_counts[order], weights[order]
+        return self._get(("pair displacements", cell_type1, cell_type2, max_radius), build)
+
+    def num_cells(self, cell_type):
+        return int(self.counts[cell_type].sum())
+
+    def window_area(self):
+        """Number of sites in the x-y bounding box"""
+        return int(np.prod((self.upper - self.lower + 1)[:2]))
+
+
+
+class IncrementalLattice(Lattice):
+    """Lattice of a sample over time, updated by the cells that changed between timepoints
+
+    The grid is fixed to cover every timepoint. Each update applies the difference
+    between the previous and the new counts of each site, so neighbor counts are
+    updated by adding or removing the disk kernel around the changed sites and
+    quadrat counts by adding the changes to their quadrats, instead of being
+    recalculated over the whole grid. The number of cells of each type is kept
+    as a running total.
+    """
+
+    def __init__(self, lower, upper):
+        self.lower = np.asarray(lower)
+        self.upper = np.asarray(upper)
+        self.origin = np.minimum(self.lower, 0)
+        self.shape = tuple(self.upper - self.origin + 1)
+        self.indices = {t: np.empty((0, len(self.shape)), dtype=int) for t in CELL_TYPES}
+        self.counts = {t: np.zeros(self.shape, dtype=int) for t in CELL_TYPES}
+        self.totals = {t: 0 for t in CELL_TYPES}
+        self.cache = {}
+
+    def num_cells(self, cell_type):
+        return self.totals[cell_type]
+
+    def update(self, type_coords):
+        """Move the lattice to the next timepoint's cells of each type"""
+        all_coords = np.concatenate(list(type_coords.values()))
+        previous_lower = self.lower
+        self.lower = all_coords.min(axis=0)
+        self.upper = all_coords.max(axis=0)
+        for cell_type, coords in type_coords.items():
+            indices = coords - self.origin
+            new_sites = np.ravel_multi_index(tuple(indices.T), self.shape)
+            old_sites = np.ravel_multi_index(tuple(self.indices[cell_type].T), self.shape)
+            # sites whose number of cells changed and by how much
+            sites, inverse = np.unique(np.concatenate([new_sites, old_sites]), return_inverse=True)
+            signs = np.concatenate([np.ones(len(new_sites)), -np.ones(len(old_sites))])
+            change = np.rint(np.bincount(inverse, weights=signs)).astype(int)
+            sites, change = sites[change != 0], change[change != 0]
+
+            self.counts[cell_type].ravel()[sites] += change
+            self.totals[cell_type] += int(change.sum())
+            self.indices[cell_type] = indices
+            self.update_cache(cell_type, sites, change, np.array_equal(previous_lower, self.lower))
+
+    def update_cache(self, cell_type, sites, change, same_lower):
+        """Apply a type's changed sites to its cached counts, dropping the other cached arrays"""
+        site_coords = np.stack(np.unravel_index(sites, self.shape), axis=1)
+        for key in list(self.cache):
+            if key[0] in ("neighbor counts", "quadrat counts") and key[1] != cell_type:
+                continue
+            if key[0] == "neighbor counts":
+                offsets = np.argwhere(disk_kernel(key[2], len(self.shape)))
+                offsets -= int(np.floor(key[2]))
+                if len(sites)*len(offsets) > np.prod(self.shape):
+                    del self.cache[key]  # cheaper to convolve again
+                    continue
+                targets = (site_coords[:, None, :] + offsets[None, :, :]).reshape(-1, len(self.shape))
+                inside = np.all((targets >= 0) & (targets < self.shape), axis=1)
+                targets = np.ravel_multi_index(tuple(targets[inside].T), self.shape)
+                np.add.at(self.cache[key].ravel(), targets, np.repeat(change, len(offsets))[inside])
+            elif key[0] == "quadrat counts" and same_lower:
+                side_length = key[2]
+                start = self.lower - self.origin
+                blocks = np.ravel_multi_index(tuple(((site_coords - start) // side_length).T),
+                                              self.quadrat_shape(side_length))
+                np.add.at(self.cache[key], blocks, change)
+            else:
+                del self.cache[key]
+
+
+def cross_k_function(lattice, cell_type1, cell_type2, radii):
+    """Translation corrected cross-K function at each radius"""
+    pairs = pp.num_pairs(lattice.num_cells(cell_type1), lattice.num_cells(cell_type2),
+                         cell_type1 == cell_type2)
+    if pairs <= 0:
+        return np.full(len(radii), np.nan)
+    distances, pair_counts, weights = lattice.weighted_pair_displacements(
+        cell_type1, cell_type2, radii[-1]
+    )
+    counts = np.bincount(np.searchsorted(radii, distances, side="left"),
+                         weights=pair_counts*weights, minlength=len(radii))[:len(radii)]
+    return lattice.window_area() / pairs * np.cumsum(counts)
+
+
+def cross_pair_correlation(lattice, cell_type1, cell_type2, radii, annulus_width):
+    """Translation corrected cross pair correlation function in annuli centered at each radius"""
+    pairs = pp.num_pairs(lattice.num_cells(cell_type1), lattice.num_cells(cell_type2),
+                         cell_type1 == cell_type2)
+    if pairs <= 0:
+        return np.full(len(radii), np.nan)
+    inner = np.maximum(radii - annulus_width/2, 0)
+    outer = radii + annulus_width/2
+    distances, pair_counts, weights = lattice.weighted_pair_displacements(
+        cell_type1, cell_type2, outer[-1]
+    )
+    cumulative_weights = np.concatenate(([0], np.cumsum(pair_counts*weights)))
+    annulus_counts = (cumulative_weights[np.searchsorted(distances, outer, side="left")]
+                      - cumulative_weights[np.searchsorted(distances, inner, side="left")])
+    annulus_areas = np.pi*(outer**2 - inner**2)
+    density = pairs / lattice.window_area()
+    return annulus_counts / (density*annulus_areas)
+
+
+def fits_lattice(num_cells, lower, upper):
+    """Check if num_cells cells between lower and upper are worth rasterizing"""
+    num_sites = np.prod(np.asarray(upper) - np.minimum(lower, 0) + 1, dtype=float)
+    return num_sites <= MAX_LATTICE_SITES and num_cells >= MIN_LATTICE_DENSITY*num_sites
+
+
+def build_lattice(df):
+    """Lattice of the sample, or None if its coordinates are not integral or too sparse"""
+    context = get_context(df)
+    type_coords = {cell_type: context.coords(cell_type) for cell_type in CELL_TYPES}
+    all_coords = np.concatenate(list(type_coords.values()))
+    if len(all_coords) == 0 or not np.all(np.mod(all_coords, 1) == 0):
+        return None
+    if not fits_lattice(len(all_coords), all_coords.min(axis=0), all_coords.max(axis=0)):
+        return None
+    return Lattice({cell_type: coords.astype(int) for cell_type, coords in type_coords.items()})
+
+
+def get_lattice(df):
+    """Lattice of the sample built once per sample, None if it should not be used"""
+    return get_context(df).get("lattice", lambda: build_lattice(df))
+
+
+def quadrat_correlation(lattice, side_length, iterations=1000, seed=None, base_side_length=None):
+    """Standardized effect size of the correlation of sensitive and resistant quadrat counts
+
+    The Pearson correlation of the two types' counts over the non-empty quadrats is
+    compared to its distribution when the type labels are shuffled between cells.
+    Shuffling keeps the number of cells in each quadrat, so each shuffle is a
+    multivariate hypergeometric draw of the sensitive cells over the quadrats.
+    This null distribution is not muspan's, so the values are not interchangeable
+    with qcm's muspan backend.
+    base_side_length is passed on to Lattice.quadrat_counts.
+    """
+    s_counts = lattice.quadrat_counts("sensitive", side_length, base_side_length)
+    r_counts = lattice.quadrat_counts("resistant", side_length, base_side_length)
+    totals = s_counts + r_counts
+    keep = totals > 0
+    s_counts, r_counts, totals = s_counts[keep], r_counts[keep], totals[keep]
+
+    def correlation(s, r):
+        s = s - s.mean(axis=-1, keepdims=True)
+        r = r - r.mean(axis=-1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (s*r).sum(axis=-1) / np.sqrt((s**2).sum(axis=-1)*(r**2).sum(axis=-1))
+
+    rng = np.random.default_rng(seed)
+    null_s = rng.multivariate_hypergeometric(totals, s_counts.sum(), size=iterations)
+    null = correlation(null_s, totals - null_s)
+    observed = correlation(s_counts, r_counts)
+    return (observed - np.nanmean(null)) / np.nanstd(null)
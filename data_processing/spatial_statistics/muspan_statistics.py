@@ -1,6 +1,11 @@
 import muspan as ms
 import numpy as np
 
+from spatial_egt.data_processing.spatial_statistics import lattice as lt
+from spatial_egt.data_processing.spatial_statistics import point_pattern as pp
+from spatial_egt.data_processing.spatial_statistics.alpha_shapes import alpha_shape_patches
+from spatial_egt.data_processing.spatial_statistics.sample_context import get_context
+
 
 def create_muspan_domain(df):
     domain = ms.domain("sample")
@@ -10,20 +15,91 @@ def create_muspan_domain(df):
     return domain
 
 
+# The cross point pattern statistics (nn_dist, cpcf, cross_k, anni) and the patch
+# statistics (patch_count, area_dist, circularity_dist) take backend="fast" to be
+# calculated by point_pattern and alpha_shapes instead of by muspan, and qcm takes
+# backend="lattice" to be calculated from the quadrat counts of the sample's lattice.
+# cpcf and cross_k also take backend="fft" to be calculated from the FFT
+# cross-correlation of the lattice, for samples with integer coordinates.
+def get_muspan_domain(df, *derivation):
+    """Get the sample's muspan domain, building it only once per sample
+
+    Statistics that add objects to the domain (hexgrids, quadrats, shapes) pass a
+    derivation key so they get their own domain, shared only with statistics
+    that add the exact same objects.
+    """
+    return get_context(df).get(("muspan domain", *derivation), lambda: create_muspan_domain(df))
+
+
+def get_hexgrid_domain(df, side_length):
+    """Get a domain containing the "grids" hexgrid collection of the given side length"""
+    def build():
+        domain = create_muspan_domain(df)
+        ms.region_based.generate_hexgrid(domain, side_length=side_length,
+                                         regions_collection_name="grids")
+        return domain
+    return get_context(df).get(("muspan domain", "hexgrid", side_length), build)
+
+
+def get_shape_domain(df, cell_type, alpha):
+    """Get a domain containing the "shape" alpha shape collection of cell_type"""
+    def build():
+        domain = create_muspan_domain(df)
+        domain.convert_objects(
+            population=("type", cell_type),
+            collection_name="shape",
+            object_type="shape",
+            conversion_method="alpha shape",
+            conversion_method_kwargs={"alpha": alpha},
+        )
+        return domain
+    return get_context(df).get(("muspan domain", "alpha shape", cell_type, alpha), build)
+
+
+def morans_i(df, cell_type, side_length):
+    """Global and local Moran's I of the hexgrid region counts of cell_type
+
+    Calculated once per sample, cell type and side length, so global_moransi and
+    local_moransi_dist share one calculation. The hexgrid (and its region counts of
+    every cell type) is shared by both cell types through get_hexgrid_domain.
+    """
+    def build():
+        domain = get_hexgrid_domain(df, side_length)
+        network_kwargs = {"network_type": "Proximity", "min_edge_distance": 0, "max_edge_distance": 1}
+        gmi, _, lmi, _, _ = ms.spatial_statistics.morans_i(domain, population=("Collection", "grids"),
+                                                           label_name=f"region counts: {cell_type}",
+                                                           network_kwargs=network_kwargs)
+        return gmi, lmi
+    return get_context(df).get(("morans i", cell_type, side_length), build)
+
+
+def sweep(values, calculate):
+    """calculate of each value of a swept argument by value, or of a single value"""
+    if isinstance(values, list):
+        return {value: calculate(value) for value in values}
+    return calculate(values)
+
+
+def require_lattice(df, backend):
+    """Get the sample's lattice for a lattice based backend"""
+    lattice = lt.get_lattice(df)
+    if lattice is None:
+        raise ValueError(f"The {backend} backend requires dense integer coordinates.")
+    return lattice
+
+
 def local_moransi_dist(df, cell_type, side_length):
-    domain = create_muspan_domain(df)
-    ms.region_based.generate_hexgrid(domain, side_length=side_length,
-                                     regions_collection_name="grids")
-    network_kwargs = {"network_type": "Proximity", "min_edge_distance": 0, "max_edge_distance": 1}
-    _, _, lmi, _, _ = ms.spatial_statistics.morans_i(domain, population=("Collection", "grids"),
-                                                     label_name=f"region counts: {cell_type}",
-                                                     network_kwargs=network_kwargs)
+    _, lmi = morans_i(df, cell_type, side_length)
     lmi = lmi[(lmi > 1) | (lmi < -1)] #remove hexes with no cell_type cells
     return lmi
 
 
-def nn_dist(df, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def nn_dist(df, cell_type1="sensitive", cell_type2="resistant", backend="muspan"):
+    if backend == "fast":
+        return pp.nearest_neighbour_distances(
+            pp.get_tree(df, cell_type1), pp.get_tree(df, cell_type2), cell_type1 == cell_type2
+        )
+    domain = get_muspan_domain(df)
     nn = ms.spatial_statistics.nearest_neighbour_distribution(
         domain=domain,
         population_A=("type", cell_type1),
@@ -32,8 +108,18 @@ def nn_dist(df, cell_type1="sensitive", cell_type2="resistant"):
     return nn
 
 
-def cpcf(df, max_radius, annulus_step, annulus_width, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def cpcf(df, max_radius, annulus_step, annulus_width, cell_type1="sensitive", cell_type2="resistant",
+         backend="muspan"):
+    if backend == "fft":
+        return lt.cross_pair_correlation(require_lattice(df, backend), cell_type1, cell_type2,
+                                         pp.get_radii(max_radius, annulus_step), annulus_width)
+    if backend == "fast":
+        return pp.cross_pair_correlation(
+            pp.get_tree(df, cell_type1), pp.get_tree(df, cell_type2),
+            pp.get_radii(max_radius, annulus_step), annulus_width, pp.get_bounds(df),
+            cell_type1 == cell_type2
+        )
+    domain = get_muspan_domain(df)
     _, pcf = ms.spatial_statistics.cross_pair_correlation_function(
         domain=domain,
         population_A=("type", cell_type1),
@@ -45,8 +131,18 @@ def cpcf(df, max_radius, annulus_step, annulus_width, cell_type1="sensitive", ce
     return pcf
 
 
-def cross_k(df, max_radius, step, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def cross_k(df, max_radius, step, cell_type1="sensitive", cell_type2="resistant", backend="muspan"):
+    if backend == "fft":
+        ck = lt.cross_k_function(require_lattice(df, backend), cell_type1, cell_type2,
+                                 pp.get_radii(max_radius, step))
+        return ck[1:]
+    if backend == "fast":
+        ck = pp.cross_k_function(
+            pp.get_tree(df, cell_type1), pp.get_tree(df, cell_type2),
+            pp.get_radii(max_radius, step), pp.get_bounds(df), cell_type1 == cell_type2
+        )
+        return ck[1:]
+    domain = get_muspan_domain(df)
     _, ck = ms.spatial_statistics.cross_k_function(
         domain=domain,
         population_A=("type", cell_type1),
@@ -58,7 +154,7 @@ def cross_k(df, max_radius, step, cell_type1="sensitive", cell_type2="resistant"
 
 
 def j_function(df, cell_type, radius_step):
-    domain = create_muspan_domain(df)
+    domain = get_muspan_domain(df)
     _, j, _ = ms.spatial_statistics.J_function(
         domain=domain,
         population=("type", cell_type),
@@ -68,8 +164,13 @@ def j_function(df, cell_type, radius_step):
     return j
 
 
-def anni(df, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+def anni(df, cell_type1="sensitive", cell_type2="resistant", backend="muspan"):
+    if backend == "fast":
+        return pp.average_nearest_neighbour_index(
+            pp.get_tree(df, cell_type1), pp.get_tree(df, cell_type2), pp.get_bounds(df),
+            cell_type1 == cell_type2
+        )
+    domain = get_muspan_domain(df)
     a, _, _ = ms.spatial_statistics.average_nearest_neighbour_index(
         domain=domain,
         population_A=("type", cell_type1),
@@ -79,7 +180,7 @@ def anni(df, cell_type1="sensitive", cell_type2="resistant"):
 
 
 def entropy(df):
-    domain = create_muspan_domain(df)
+    domain = get_muspan_domain(df)
     ent = ms.summary_statistics.label_entropy(
         domain=domain,
         label_name="type"
@@ -87,30 +188,46 @@ def entropy(df):
     return ent
 
 
-def qcm(df, side_length):
-    domain = create_muspan_domain(df)
-    ses, _, _ = ms.region_based.quadrat_correlation_matrix(
-        domain,
-        label_name="type",
-        region_method="quadrats",
-        region_kwargs=dict(side_length=side_length)
-    )
-    return ses[0][1]
+def qcm(df, side_length, backend="muspan", seed=None):
+    """Quadrat correlation of sensitive and resistant cells
+
+    backend="lattice" (see lattice.quadrat_correlation) standardizes the correlation
+    against its own null distribution, not muspan's, so its values are not on the
+    same scale as the muspan backend's and the two should not be mixed in one feature
+    set (compare_backends reports how far apart they are).
+    With backend="lattice" a sweep of side lengths sums every side length's quadrats
+    from the finest quadrats (of their greatest common divisor) and seed seeds the shuffles.
+    """
+    if backend == "lattice":
+        lattice = require_lattice(df, backend)
+        side_lengths = side_length if isinstance(side_length, list) else [side_length]
+        base_side_length = int(np.gcd.reduce(side_lengths))
+        return sweep(side_length, lambda s: lt.quadrat_correlation(
+            lattice, s, seed=seed, base_side_length=base_side_length
+        ))
+
+    def calculate(s):
+        domain = get_muspan_domain(df, "quadrats", s)
+        ses, _, _ = ms.region_based.quadrat_correlation_matrix(
+            domain,
+            label_name="type",
+            region_method="quadrats",
+            region_kwargs=dict(side_length=s)
+        )
+        return ses[0][1]
+    return sweep(side_length, calculate)
+
+
+qcm.sweep_params = ("side_length",)
 
 
 def global_moransi(df, cell_type, side_length):
-    domain = create_muspan_domain(df)
-    network_kwargs = {"network_type": "Proximity", "min_edge_distance": 0, "max_edge_distance": 1}
-    ms.region_based.generate_hexgrid(domain, side_length=side_length,
-                                     regions_collection_name="grids")
-    gmi = ms.spatial_statistics.morans_i(domain, population=("Collection", "grids"),
-                                         label_name=f"region counts: {cell_type}",
-                                         network_kwargs=network_kwargs)
-    return gmi[0]
+    gmi, _ = morans_i(df, cell_type, side_length)
+    return gmi
 
 
 def wasserstein(df, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+    domain = get_muspan_domain(df)
     wass = ms.distribution.sliced_wasserstein_distance(domain,
                                                        population_A=("type", cell_type1),
                                                        population_B=("type", cell_type2))
@@ -118,7 +235,7 @@ def wasserstein(df, cell_type1="sensitive", cell_type2="resistant"):
 
 
 def kl_divergence(df, mesh_step, cell_type1="sensitive", cell_type2="resistant"):
-    domain = create_muspan_domain(df)
+    domain = get_muspan_domain(df)
     kde1 = ms.distribution.kernel_density_estimation(
         domain,
         population=("type", cell_type1),
@@ -133,43 +250,37 @@ def kl_divergence(df, mesh_step, cell_type1="sensitive", cell_type2="resistant")
     return kl_div
 
 
-def patch_count(df, cell_type, alpha):
-    domain = create_muspan_domain(df)
-    domain.convert_objects(
-        population=("type", cell_type),
-        collection_name="shape",
-        object_type="shape",
-        conversion_method="alpha shape",
-        conversion_method_kwargs={"alpha": alpha},
-    )
-    patch_pop = ms.query.query(domain, ("collection",), "is", "shape")
-    area, _ = ms.geometry.area(domain, population=patch_pop)
-    return len(area)
+def patch_morphology(df, cell_type, alpha, backend="muspan"):
+    """Number, areas and circularities of the alpha shape patches of cell_type
 
+    The shapes are converted and measured once per sample, cell type and alpha, so
+    patch_count, area_dist and circularity_dist calculated on the same sample share them.
+    backend="fast" calculates the patches from a Delaunay triangulation (see alpha_shapes).
+    """
+    def build():
+        if backend == "fast":
+            return alpha_shape_patches(df, cell_type, alpha)
+        domain = get_shape_domain(df, cell_type, alpha)
+        patch_pop = ms.query.query(domain, ("collection",), "is", "shape")
+        area, _ = ms.geometry.area(domain, population=patch_pop)
+        circ, _ = ms.geometry.circularity(domain, population=patch_pop)
+        return len(area), area, circ
+    return get_context(df).get(("patch morphology", cell_type, alpha, backend), build)
 
-def area_dist(df, cell_type, alpha):
-    domain = create_muspan_domain(df)
-    domain.convert_objects(
-        population=("type", cell_type),
-        collection_name="shape",
-        object_type="shape",
-        conversion_method="alpha shape",
-        conversion_method_kwargs={"alpha": alpha},
-    )
-    patch_pop = ms.query.query(domain, ("collection",), "is", "shape")
-    area, _ = ms.geometry.area(domain, population=patch_pop)
-    return area
 
+def patch_count(df, cell_type, alpha, backend="muspan"):
+    return sweep(alpha, lambda a: patch_morphology(df, cell_type, a, backend)[0])
 
-def circularity_dist(df, cell_type, alpha):
-    domain = create_muspan_domain(df)
-    domain.convert_objects(
-        population=("type", cell_type),
-        collection_name="shape",
-        object_type="shape",
-        conversion_method="alpha shape",
-        conversion_method_kwargs={"alpha": alpha},
-    )
-    patch_pop = ms.query.query(domain, ("collection",), "is", "shape")
-    circ, _ = ms.geometry.circularity(domain, population=patch_pop)
-    return circ
+
+def area_dist(df, cell_type, alpha, backend="muspan"):
+    return sweep(alpha, lambda a: patch_morphology(df, cell_type, a, backend)[1])
+
+
+def circularity_dist(df, cell_type, alpha, backend="muspan"):
+    return sweep(alpha, lambda a: patch_morphology(df, cell_type, a, backend)[2])
+
+
+# with backend="fast" every alpha thresholds the circumradii of the same triangulation
+patch_count.sweep_params = ("alpha",)
+area_dist.sweep_params = ("alpha",)
+circularity_dist.sweep_params = ("alpha",)
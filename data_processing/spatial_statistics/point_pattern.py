@@ -0,0 +1,142 @@
+"""NumPy/SciPy implementations of muspan's cross point pattern statistics.
+
+These compute cross-K, cross pair correlation, cross nearest neighbour distances
+and ANNI directly from the KD-trees of each population and vectorized histograms,
+without building a muspan domain. They are selected with backend="fast" in
+muspan_statistics. The trees are taken from the sample's context, so they are built
+once per sample and shared with the other statistics.
+
+As in a muspan domain without an explicit boundary, the observation window is the
+bounding box of all cells and only the x and y coordinates are used. Pair counts are
+edge corrected with Ripley's isotropic correction: each pair is weighted by the
+inverse of the proportion of the circle around the focal cell, through the other
+cell, that lies inside the window. Within one population the K and pair correlation
+functions are normalized by the n(n-1) pairs of distinct cells, as in muspan, and
+across populations by the n1*n2 pairs.
+"""
+
+import numpy as np
+
+from spatial_egt.data_processing.spatial_statistics.sample_context import get_context
+
+
+DIMENSIONS = ("x", "y")
+
+
+def get_tree(df, cell_type):
+    """KDTree of the x and y coordinates of the cells of cell_type"""
+    return get_context(df).tree(cell_type, DIMENSIONS)
+
+
+def get_bounds(df):
+    """Bounding box ((xmin, ymin), (xmax, ymax)) of every cell in the sample"""
+    coords = get_context(df).coords(None, DIMENSIONS)
+    return coords.min(axis=0), coords.max(axis=0)
+
+
+def get_area(bounds):
+    """Area of a bounding box"""
+    return float(np.prod(bounds[1] - bounds[0]))
+
+
+def get_radii(max_radius, step):
+    """Radii from 0 to max_radius (inclusive) spaced by step"""
+    return step*np.arange(int(np.floor(max_radius/step + 1e-9)) + 1)
+
+
+def isotropic_edge_weights(points, distances, bounds):
+    """Ripley's isotropic edge correction weights for circles in a rectangular window
+
+    For each focal point and radius the excluded arc is summed over the four edges.
+    The arc beyond each edge is capped at the angle to that edge's corners, so the
+    arcs beyond two edges meeting at a corner are not counted twice.
+    """
+    lower, upper = bounds
+    to_left, to_down = (points - lower).T
+    to_right, to_up = (upper - points).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        def edge_angle(edge_distance):
+            ratio = np.clip(edge_distance / distances, 0, 1)
+            return np.where(distances > edge_distance, np.arccos(ratio), 0)
+        left_down = np.arctan2(to_down, to_left)
+        left_up = np.arctan2(to_up, to_left)
+        right_down = np.arctan2(to_down, to_right)
+        right_up = np.arctan2(to_up, to_right)
+        excluded = (
+            np.minimum(edge_angle(to_left), left_down) + np.minimum(edge_angle(to_left), left_up)
+            + np.minimum(edge_angle(to_right), right_down)
+            + np.minimum(edge_angle(to_right), right_up)
+            + np.minimum(edge_angle(to_down), np.pi/2 - left_down)
+            + np.minimum(edge_angle(to_down), np.pi/2 - right_down)
+            + np.minimum(edge_angle(to_up), np.pi/2 - left_up)
+            + np.minimum(edge_angle(to_up), np.pi/2 - right_up)
+        )
+        return 1 / (1 - excluded/(2*np.pi))
+
+
+def cross_pairs(tree1, tree2, max_radius, same_population=False):
+    """Indices and distances of every (tree1, tree2) pair within max_radius"""
+    if tree1.n == 0 or tree2.n == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0)
+    pairs = tree1.sparse_distance_matrix(tree2, max_radius, output_type="ndarray")
+    i, j, distances = pairs["i"], pairs["j"], pairs["v"]
+    if same_population:
+        keep = i != j
+        i, j, distances = i[keep], j[keep], distances[keep]
+    return i, j, distances
+
+
+def weighted_pair_distances(tree1, tree2, max_radius, bounds, same_population=False):
+    """Sorted pair distances within max_radius and their edge correction weights"""
+    i, _, distances = cross_pairs(tree1, tree2, max_radius, same_population)
+    weights = isotropic_edge_weights(tree1.data[i], distances, bounds)
+    order = np.argsort(distances)
+    return distances[order], weights[order]
+
+
+def num_pairs(n1, n2, same_population=False):
+    """Number of pairs the K and pair correlation functions are normalized by"""
+    return n1*(n2 - 1) if same_population else n1*n2
+
+
+def cross_k_function(tree1, tree2, radii, bounds, same_population=False):
+    """Edge corrected cross-K function at each radius"""
+    pairs = num_pairs(tree1.n, tree2.n, same_population)
+    if pairs <= 0:
+        return np.full(len(radii), np.nan)
+    distances, weights = weighted_pair_distances(tree1, tree2, radii[-1], bounds, same_population)
+    counts = np.bincount(np.searchsorted(radii, distances, side="left"),
+                         weights=weights, minlength=len(radii))[:len(radii)]
+    return get_area(bounds) / pairs * np.cumsum(counts)
+
+
+def cross_pair_correlation(tree1, tree2, radii, annulus_width, bounds, same_population=False):
+    """Edge corrected cross pair correlation function in annuli centered at each radius"""
+    pairs = num_pairs(tree1.n, tree2.n, same_population)
+    if pairs <= 0:
+        return np.full(len(radii), np.nan)
+    inner = np.maximum(radii - annulus_width/2, 0)
+    outer = radii + annulus_width/2
+    distances, weights = weighted_pair_distances(tree1, tree2, outer[-1], bounds, same_population)
+    cumulative_weights = np.concatenate(([0], np.cumsum(weights)))
+    annulus_counts = (cumulative_weights[np.searchsorted(distances, outer, side="left")]
+                      - cumulative_weights[np.searchsorted(distances, inner, side="left")])
+    annulus_areas = np.pi*(outer**2 - inner**2)
+    density = pairs / get_area(bounds)
+    return annulus_counts / (density*annulus_areas)
+
+
+def nearest_neighbour_distances(tree1, tree2, same_population=False):
+    """Distance from each tree1 point to its nearest tree2 point"""
+    if same_population:
+        distances, _ = tree2.query(tree1.data, k=2)
+        return distances[:, 1]
+    distances, _ = tree2.query(tree1.data)
+    return distances
+
+
+def average_nearest_neighbour_index(tree1, tree2, bounds, same_population=False):
+    """Mean nearest neighbour distance over its expectation under complete spatial randomness"""
+    distances = nearest_neighbour_distances(tree1, tree2, same_population)
+    expected = 0.5*np.sqrt(get_area(bounds) / tree2.n)
+    return np.mean(distances) / expected
@@ -0,0 +1,74 @@
+"""Cache of structures shared by the spatial statistics of one sample.
+
+When several statistics are calculated on the same sample DataFrame, expensive
+structures (coordinate arrays split by cell type, KD-trees, muspan domains) are built
+on first use and reused by the following statistics instead of being rebuilt by each one.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import KDTree
+
+
+class SampleContext:
+    """Lazily built structures of a single sample"""
+
+    def __init__(self, df):
+        self.df = df
+        self.cache = {}
+
+    def get(self, key, build):
+        """Return the structure stored under key, calling build() the first time"""
+        if key not in self.cache:
+            self.cache[key] = build()
+        return self.cache[key]
+
+    def peek(self, key):
+        """Return the structure stored under key if it has been built, otherwise None"""
+        return self.cache.get(key)
+
+    def dimensions(self):
+        """Names of the coordinate columns"""
+        return self.get("dimensions", lambda: [c for c in self.df.columns if c != "type"])
+
+    def coords(self, cell_type=None, dimensions=None):
+        """Float coordinates of the cells of cell_type (all cells if None)
+
+        :param dimensions: the coordinate columns to use, all of them if None
+        """
+        dimensions = tuple(self.dimensions() if dimensions is None else dimensions)
+        def build():
+            df = self.df if cell_type is None else self.df[self.df["type"] == cell_type]
+            return np.ascontiguousarray(df[list(dimensions)].values, dtype=float)
+        return self.get(("coords", cell_type, dimensions), build)
+
+    def tree(self, cell_type=None, dimensions=None):
+        """KDTree of the cells of cell_type (all cells if None)"""
+        dimensions = tuple(self.dimensions() if dimensions is None else dimensions)
+        return self.get(("tree", cell_type, dimensions),
+                        lambda: KDTree(self.coords(cell_type, dimensions)))
+
+
+# every statistic of a sample is calculated before moving to the next sample,
+# so only the contexts of the most recently used samples need to be kept
+MAX_CONTEXTS = 1
+_contexts = OrderedDict()
+
+
+def get_context(df):
+    """Get the context of the given sample DataFrame
+
+    Contexts are looked up by DataFrame object, so they are reused as long as the
+    same DataFrame is passed to each statistic. Only the MAX_CONTEXTS most recently
+    used samples are kept.
+    """
+    key = id(df)
+    context = _contexts.get(key)
+    if context is None or context.df is not df:
+        context = SampleContext(df)
+        _contexts[key] = context
+    _contexts.move_to_end(key)
+    while len(_contexts) > MAX_CONTEXTS:
+        _contexts.popitem(last=False)
+    return context
@@ -0,0 +1,311 @@
+"""Tiled calculation of local spatial statistics for samples too large to process at once.
+
+The x-y plane is partitioned into square tiles and each tile is processed with only
+its own cells plus the cells in a halo around it, as wide as the statistic's
+interaction radius. Trees and triangulations are built per tile, so memory is bounded
+by the size of the tiles being processed rather than of the sample, and tiles can be
+processed in parallel. Apart from the tile of each cell, coordinates are only read per
+tile, so samples read from a store (whose columns are memory mapped) are not loaded
+into memory all at once.
+
+Results are merged exactly:
+- tiled_nc_dist: the neighbors of a tile's cells within the radius are in the tile or halo
+- tiled_nn_dist: nearest neighbours within the halo are exact, cells without one are
+  queried against a tree of the whole neighbour population
+- tiled_cross_k: edge corrected pair counts are summed over the tiles of the focal cells,
+  with weights from the bounding box of the whole sample
+- tiled patch statistics: alpha shape triangles (circumradius below alpha) are kept by
+  the tile containing their circumcenter, with a halo of twice alpha, and patches are
+  joined across tiles through the triangles' shared edges
+
+Distributions are returned in the same order as the untiled statistics, except for the
+patch distributions, which contain the same values in a different order.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import Delaunay, KDTree, QhullError
+
+from spatial_egt.data_processing.spatial_statistics import point_pattern as pp
+from spatial_egt.data_processing.spatial_statistics.custom import (
+    neighbor_type_counts,
+    neighborhood_fractions,
+)
+from spatial_egt.data_processing.spatial_statistics.sample_context import get_context
+
+
+class Tiling:
+    """Assignment of a sample's cells to square tiles of the x-y plane"""
+
+    def __init__(self, df, tile_size):
+        self.df = df
+        self.tile_size = tile_size
+        xy = [df[d].values for d in pp.DIMENSIONS]
+        self.lower = np.array([v.min() for v in xy], dtype=float)
+        self.upper = np.array([v.max() for v in xy], dtype=float)
+        self.shape = np.floor((self.upper - self.lower) / tile_size).astype(int) + 1
+        tile_ids = self.tile_of(np.stack(xy, axis=1))
+        self.order = np.argsort(tile_ids, kind="stable")
+        self.starts = np.searchsorted(tile_ids[self.order], np.arange(np.prod(self.shape) + 1))
+
+    def tile_of(self, points):
+        """Tile id of each point, points beyond the bounding box are in the edge tiles"""
+        tile_xy = np.floor((points - self.lower) / self.tile_size).astype(np.int64)
+        tile_xy = np.clip(tile_xy, 0, self.shape - 1)
+        return tile_xy[:, 0]*self.shape[1] + tile_xy[:, 1]
+
+    def tiles(self):
+        """Ids of the tiles containing cells"""
+        return np.flatnonzero(np.diff(self.starts))
+
+    def cells(self, tile, halo):
+        """Indices of the cells in the tile and of the cells in its halo"""
+        tx, ty = divmod(tile, self.shape[1])
+        core = self.order[self.starts[tile]:self.starts[tile+1]]
+        ring = int(np.ceil(halo / self.tile_size))
+        neighbors = []
+        for nx in range(max(tx - ring, 0), min(tx + ring + 1, self.shape[0])):
+            for ny in range(max(ty - ring, 0), min(ty + ring + 1, self.shape[1])):
+                neighbor = nx*self.shape[1] + ny
+                if neighbor != tile:
+                    neighbors.append(self.order[self.starts[neighbor]:self.starts[neighbor+1]])
+        halo_cells = np.concatenate(neighbors) if neighbors else np.empty(0, dtype=int)
+        low = self.lower + np.array([tx, ty])*self.tile_size - halo
+        high = low + self.tile_size + 2*halo
+        points = self.coords(halo_cells, pp.DIMENSIONS)
+        inside = np.all((points >= low) & (points <= high), axis=1)
+        return core, halo_cells[inside]
+
+    def coords(self, indices, dimensions):
+        return np.stack([self.df[d].values[indices] for d in dimensions], axis=1).astype(float)
+
+    def is_type(self, indices, cell_type):
+        return np.asarray(self.df["type"].values[indices] == cell_type)
+
+    def map_tiles(self, process_tile, workers=1):
+        """Results of process_tile(tile) for every tile containing cells"""
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(process_tile, self.tiles()))
+        return [process_tile(tile) for tile in self.tiles()]
+
+
+def get_tiling(df, tile_size):
+    return get_context(df).get(("tiling", tile_size), lambda: Tiling(df, tile_size))
+
+
+def merge_in_order(indices, values):
+    """Concatenate per tile values and sort them by their cells' indices"""
+    indices = np.concatenate(indices)
+    values = np.concatenate(values)
+    return values[np.argsort(indices, kind="stable")]
+
+
+# Neighborhood Composition
+def tiled_nc_dist(df, radius, return_fs=True, tile_size=1000, workers=1):
+    """nc_dist calculated tile by tile, with a halo of the (largest) radius"""
+    tiling = get_tiling(df, tile_size)
+    dimensions = get_context(df).dimensions()
+    if return_fs:
+        focal_type, other_type = "resistant", "sensitive"
+    else:
+        focal_type, other_type = "sensitive", "resistant"
+    radii = sorted(radius) if isinstance(radius, list) else [radius]
+
+    def process_tile(tile):
+        core, halo_cells = tiling.cells(tile, radii[-1])
+        cells = np.concatenate([core, halo_cells])
+        points = tiling.coords(cells, dimensions)
+        trees = [KDTree(points[tiling.is_type(cells, t)]) for t in (focal_type, other_type)]
+        focal = tiling.is_type(core, focal_type)
+        focal_points = points[:len(core)][focal]
+        counts = np.stack([neighbor_type_counts(focal_points, trees, r) for r in radii], axis=-1)
+        return core[focal], counts
+
+    results = tiling.map_tiles(process_tile, workers)
+    counts = merge_in_order([r[0] for r in results], [r[1] for r in results])
+    fractions = {r: neighborhood_fractions(counts[:, :, k]) for k, r in enumerate(radii)}
+    return fractions if isinstance(radius, list) else fractions[radius]
+
+
+tiled_nc_dist.sweep_params = ("radius",)
+
+
+# Nearest Neighbours
+def tiled_nn_dist(df, cell_type1="sensitive", cell_type2="resistant", halo=50, tile_size=1000,
+                  workers=1):
+    """nn_dist (backend="fast") calculated tile by tile
+
+    Cells whose nearest neighbour is further than the halo are queried against a tree
+    of all cell_type2 cells, which is only built if there are any.
+    """
+    tiling = get_tiling(df, tile_size)
+    same_population = cell_type1 == cell_type2
+    k = 2 if same_population else 1
+
+    def process_tile(tile):
+        core, halo_cells = tiling.cells(tile, halo)
+        cells = np.concatenate([core, halo_cells])
+        points = tiling.coords(cells, pp.DIMENSIONS)
+        tree = KDTree(points[tiling.is_type(cells, cell_type2)])
+        focal = tiling.is_type(core, cell_type1)
+        if tree.n < k:
+            return core[focal], np.full(np.sum(focal), np.inf)
+        distances, _ = tree.query(points[:len(core)][focal], k=k, distance_upper_bound=halo)
+        return core[focal], distances[:, 1] if same_population else distances
+
+    results = tiling.map_tiles(process_tile, workers)
+    distances = merge_in_order([r[0] for r in results], [r[1] for r in results])
+    missing = np.isinf(distances)
+    if np.any(missing):
+        tree = pp.get_tree(df, cell_type2)
+        focal_points = get_context(df).coords(cell_type1, pp.DIMENSIONS)[missing]
+        if same_population:
+            distances[missing] = tree.query(focal_points, k=2)[0][:, 1]
+        else:
+            distances[missing] = tree.query(focal_points)[0]
+    return distances
+
+
+# Cross-K
+def tiled_cross_k(df, max_radius, step, cell_type1="sensitive", cell_type2="resistant",
+                  tile_size=1000, workers=1):
+    """cross_k (backend="fast") calculated tile by tile, with a halo of max_radius"""
+    tiling = get_tiling(df, tile_size)
+    radii = pp.get_radii(max_radius, step)
+    bounds = (tiling.lower, tiling.upper)
+    same_population = cell_type1 == cell_type2
+
+    def process_tile(tile):
+        core, halo_cells = tiling.cells(tile, max_radius)
+        cells = np.concatenate([core, halo_cells])
+        points = tiling.coords(cells, pp.DIMENSIONS)
+        focal = tiling.is_type(core, cell_type1)
+        other = tiling.is_type(cells, cell_type2)
+        focal_tree = KDTree(points[:len(core)][focal])
+        other_tree = KDTree(points[other])
+        i, j, distances = pp.cross_pairs(focal_tree, other_tree, max_radius)
+        if same_population:
+            keep = core[focal][i] != cells[other][j]
+            i, distances = i[keep], distances[keep]
+        weights = pp.isotropic_edge_weights(focal_tree.data[i], distances, bounds)
+        counts = np.bincount(np.searchsorted(radii, distances, side="left"),
+                             weights=weights, minlength=len(radii))[:len(radii)]
+        return np.sum(focal), np.sum(other[:len(core)]), counts
+
+    results = tiling.map_tiles(process_tile, workers)
+    n1 = sum(r[0] for r in results)
+    n2 = sum(r[1] for r in results)
+    pairs = pp.num_pairs(n1, n2, same_population)
+    if pairs <= 0:
+        return np.full(len(radii) - 1, np.nan)
+    counts = np.sum([r[2] for r in results], axis=0)
+    ck = pp.get_area(bounds) / pairs * np.cumsum(counts)
+    return ck[1:]
+
+
+# Patches
+def triangle_geometry(points):
+    """Edge lengths (edge k opposite vertex k), areas, circumcenters and circumradii"""
+    edge_lengths = np.stack([
+        np.linalg.norm(points[:, 2] - points[:, 1], axis=1),
+        np.linalg.norm(points[:, 0] - points[:, 2], axis=1),
+        np.linalg.norm(points[:, 1] - points[:, 0], axis=1),
+    ], axis=1)
+    side1 = points[:, 1] - points[:, 0]
+    side2 = points[:, 2] - points[:, 0]
+    cross = side1[:, 0]*side2[:, 1] - side1[:, 1]*side2[:, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        circumradii = np.prod(edge_lengths, axis=1) / (2*np.abs(cross))
+        norms1 = np.sum(side1**2, axis=1)
+        norms2 = np.sum(side2**2, axis=1)
+        circumcenters = points[:, 0] + np.stack([
+            side2[:, 1]*norms1 - side1[:, 1]*norms2,
+            side1[:, 0]*norms2 - side2[:, 0]*norms1,
+        ], axis=1) / (2*cross[:, None])
+    return edge_lengths, np.abs(cross) / 2, circumcenters, circumradii
+
+
+def tiled_patch_morphology(df, cell_type, alpha, tile_size=1000, workers=1):
+    """Number, areas and circularities of the alpha shape patches of cell_type, by tile
+
+    Each tile triangulates its cells and halo, and keeps the triangles with a
+    circumradius below alpha whose circumcenter is in the tile. Vertices are ordered
+    by cell index before measuring, so a triangle found by several tiles gets the same
+    circumcenter in each, and exactly one tile keeps it.
+    """
+    tiling = get_tiling(df, tile_size)
+
+    def process_tile(tile):
+        core, halo_cells = tiling.cells(tile, 2*alpha)
+        cells = np.concatenate([core, halo_cells])
+        cells = cells[tiling.is_type(cells, cell_type)]
+        if len(cells) < 3:
+            return np.empty((0, 3), dtype=int), np.empty((0, 3)), np.empty(0)
+        points = tiling.coords(cells, pp.DIMENSIONS)
+        try:
+            simplices = Delaunay(points).simplices
+        except QhullError:
+            return np.empty((0, 3), dtype=int), np.empty((0, 3)), np.empty(0)
+        order = np.argsort(cells[simplices], axis=1)
+        simplices = np.take_along_axis(simplices, order, axis=1)
+        edge_lengths, areas, circumcenters, circumradii = triangle_geometry(points[simplices])
+        keep = (circumradii < alpha) & (tiling.tile_of(circumcenters) == tile)
+        return cells[simplices[keep]], edge_lengths[keep], areas[keep]
+
+    results = tiling.map_tiles(process_tile, workers)
+    triangles = np.concatenate([r[0] for r in results])
+    edge_lengths = np.concatenate([r[1] for r in results])
+    areas = np.concatenate([r[2] for r in results])
+    if len(triangles) == 0:
+        return 0, np.empty(0), np.empty(0)
+
+    # edges are keyed by their sorted vertices, edge k is opposite vertex k
+    num_cells = len(df)
+    edges = np.stack([
+        triangles[:, 1]*num_cells + triangles[:, 2],
+        triangles[:, 0]*num_cells + triangles[:, 2],
+        triangles[:, 0]*num_cells + triangles[:, 1],
+    ], axis=1).ravel()
+    edge_triangles = np.repeat(np.arange(len(triangles)), 3)
+    order = np.argsort(edges, kind="stable")
+    edges, edge_triangles = edges[order], edge_triangles[order]
+    shared = np.flatnonzero(edges[1:] == edges[:-1])
+    adjacency = coo_matrix((np.ones(len(shared)), (edge_triangles[shared], edge_triangles[shared+1])),
+                           shape=(len(triangles), len(triangles)))
+    num_patches, labels = connected_components(adjacency, directed=False)
+
+    boundary = np.ones(len(edges), dtype=bool)
+    boundary[shared] = False
+    boundary[shared+1] = False
+    boundary_lengths = np.zeros(len(edges))
+    boundary_lengths[order[boundary]] = edge_lengths.ravel()[order[boundary]]
+    perimeters = np.bincount(labels, weights=boundary_lengths.reshape(-1, 3).sum(axis=1),
+                             minlength=num_patches)
+    patch_areas = np.bincount(labels, weights=areas, minlength=num_patches)
+    return num_patches, patch_areas, 4*np.pi*patch_areas / perimeters**2
+
+
+def get_tiled_patch_morphology(df, cell_type, alpha, tile_size, workers):
+    return get_context(df).get(
+        ("tiled patch morphology", cell_type, alpha, tile_size),
+        lambda: tiled_patch_morphology(df, cell_type, alpha, tile_size, workers)
+    )
+
+
+def tiled_patch_count(df, cell_type, alpha, tile_size=1000, workers=1):
+    count, _, _ = get_tiled_patch_morphology(df, cell_type, alpha, tile_size, workers)
+    return count
+
+
+def tiled_area_dist(df, cell_type, alpha, tile_size=1000, workers=1):
+    _, area, _ = get_tiled_patch_morphology(df, cell_type, alpha, tile_size, workers)
+    return area
+
+
+def tiled_circularity_dist(df, cell_type, alpha, tile_size=1000, workers=1):
+    _, _, circ = get_tiled_patch_morphology(df, cell_type, alpha, tile_size, workers)
+    return circ
@@ -0,0 +1,167 @@
+"""Persistent cache of per-sample spatial statistic results.
+
+Results are saved in data/{data_type}/cache/{statistic_name}/{key}.pkl where the key is
+a hash of the sample's contents, the statistic name, its calculation arguments, the
+source code of the module defining the statistic and of every spatial_statistics
+module (which the statistics share their implementations through), and the installed
+muspan version. Changing any of these misses the cache, so only new or modified samples and statistics are recalculated.
+Each result is saved as the dict of the statistic's output columns.
+
+Expected usage to invalidate or trim the cache:
+python3 -m spatial_egt.data_processing.statistic_cache -dir data_type (-stat names) (-max_mb size)
+
+Where:
+-stat: the statistics to remove from the cache, "all" to clear it
+-max_mb: evict the least recently used results until the cache is below this size
+"""
+
+import argparse
+from functools import lru_cache
+from glob import glob
+import hashlib
+from importlib.metadata import PackageNotFoundError, version
+import inspect
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.processed_store import CELL_TYPES, is_store, open_store
+
+
+MISS = object()
+# increment when the format of cached results changes
+CACHE_VERSION = 2
+
+
+STATISTICS_PATH = f"{os.path.dirname(os.path.abspath(__file__))}/spatial_statistics"
+
+
+@lru_cache(maxsize=None)
+def get_code_version(*module_files):
+    """Hash of the given source files"""
+    code_hash = hashlib.sha256()
+    for module_file in module_files:
+        with open(module_file, "rb") as f:
+            code_hash.update(f.read())
+    return code_hash.hexdigest()
+
+
+def get_muspan_version():
+    try:
+        return version("muspan")
+    except PackageNotFoundError:
+        return None
+
+
+def get_statistic_code_version(stat_calculation):
+    """Hash of the code a statistic is calculated with
+
+    Covers the module the statistic is defined in, every spatial_statistics module,
+    and the muspan version.
+    """
+    module_files = {os.path.abspath(inspect.getsourcefile(stat_calculation))}
+    module_files |= {os.path.abspath(f) for f in glob(f"{STATISTICS_PATH}/*.py")}
+    code_version = get_code_version(*sorted(module_files))
+    return f"{code_version} muspan {get_muspan_version()}"
+
+
+def get_sample_hash(data_path, file_name):
+    """Hash of a sample's contents, read from a processed csv or a store
+
+    The parsed coordinate columns, as float64, and the cell type codes are hashed, so
+    the same sample has the same hash whether it is read from its csv or a store.
+    """
+    if is_store(data_path):
+        store = open_store(data_path)
+        coords, types = store.sample_arrays(store.sample_index[file_name])
+    else:
+        df = pd.read_csv(f"{data_path}/{file_name}")
+        coords = {column: df[column].to_numpy() for column in df.columns if column != "type"}
+        types = pd.Categorical(df["type"], categories=CELL_TYPES).codes
+    sample_hash = hashlib.sha256()
+    for column, values in coords.items():
+        sample_hash.update(column.encode())
+        sample_hash.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    sample_hash.update(np.ascontiguousarray(types, dtype=np.int8).tobytes())
+    return sample_hash.hexdigest()
+
+
+class StatisticCache:
+    """Content-addressed results stored under one cache directory"""
+
+    def __init__(self, cache_path):
+        self.path = cache_path
+
+    def key(self, sample_hash, stat_name, stat_calculation, stat_args):
+        """Cache key of a statistic calculated on a sample"""
+        code_version = get_statistic_code_version(stat_calculation)
+        arguments = json.dumps(stat_args, sort_keys=True, default=str)
+        key = "\n".join([
+            str(CACHE_VERSION), sample_hash, stat_name, stat_calculation.__name__, arguments, code_version
+        ])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def load(self, stat_name, key):
+        """Cached result, or MISS if it has not been calculated"""
+        file_name = f"{self.path}/{stat_name}/{key}.pkl"
+        try:
+            with open(file_name, "rb") as f:
+                result = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return MISS
+        os.utime(file_name)  # mark as recently used for eviction
+        return result
+
+    def save(self, stat_name, key, result):
+        """Cache a result, writing to a temporary file first so readers never see partial files"""
+        stat_path = f"{self.path}/{stat_name}"
+        os.makedirs(stat_path, exist_ok=True)
+        temp_file_name = f"{stat_path}/{key}.{os.getpid()}.tmp"
+        with open(temp_file_name, "wb") as f:
+            pickle.dump(result, f)
+        os.replace(temp_file_name, f"{stat_path}/{key}.pkl")
+
+    def invalidate(self, stat_names=None):
+        """Remove the cached results of the given statistics, or all of them if None"""
+        if stat_names is None:
+            stat_names = os.listdir(self.path)
+        for stat_name in stat_names:
+            shutil.rmtree(f"{self.path}/{stat_name}", ignore_errors=True)
+
+    def evict(self, max_bytes):
+        """Remove the least recently used results until the cache is at most max_bytes"""
+        entries = []
+        for stat_name in os.listdir(self.path):
+            for entry in os.scandir(f"{self.path}/{stat_name}"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_bytes <= max_bytes:
+                break
+            os.remove(file_name)
+            total_bytes -= size
+
+
+def main():
+    """Invalidate or evict cached statistics"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--data_type", type=str, default="in_silico")
+    parser.add_argument("-stat", "--statistic", type=str, nargs="+", default=None)
+    parser.add_argument("-max_mb", "--max_mb", type=float, default=None)
+    args = parser.parse_args()
+
+    cache = StatisticCache(get_data_path(args.data_type, "cache"))
+    if args.statistic is not None:
+        cache.invalidate(None if args.statistic == ["all"] else args.statistic)
+    if args.max_mb is not None:
+        cache.evict(args.max_mb * 1e6)
+
+
+if __name__ == "__main__":
+    main()
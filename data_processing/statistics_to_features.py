@@ -12,30 +12,128 @@ import os
 
 import numpy as np
 import pandas as pd
-from scipy.stats import skew
 
 from spatial_egt.common import get_data_path, get_spatial_statistic_type
+from spatial_egt.data_processing.spatial_statistics.approximate import APPROXIMATION_SUFFIXES
+from spatial_egt.data_processing.ragged_statistics import (
+    RAGGED_SUFFIX,
+    flatten_statistic,
+    read_ragged,
+)
+from spatial_egt.data_processing.sample_metadata import get_metadata
 
 
-def distribution_to_features(row, name):
-    """Distribution summary statistics"""
-    dist = row[name]
-    row[f"{name}_Mean"] = np.mean(dist)
-    sd = np.std(dist)
-    row[f"{name}_SD"] = sd
-    if sd == 0:
-        row[f"{name}_Skew"] = 0
-    else:
-        row[f"{name}_Skew"] = skew(dist)
-    return row
+def segment_reduce(ufunc, flat, offsets):
+    """Reduce each sample's segment of flat with ufunc, empty segments are nan"""
+    lengths = np.diff(offsets)
+    result = np.full(len(lengths), np.nan)
+    nonempty = lengths > 0
+    if np.any(nonempty):
+        result[nonempty] = ufunc.reduceat(flat, offsets[:-1][nonempty])
+    return result
 
 
-def function_to_features(row, name):
-    """Function summary statistics"""
-    func = row[name]
-    row[f"{name}_Min"] = min(func)
-    row[f"{name}_Max"] = max(func)
-    return row
+def distribution_to_features(df, name, flat, offsets):
+    """Distribution summary statistics, calculated for every sample at once
+
+    flat and offsets hold the samples' values in the ragged layout.
+    Matches np.mean, np.std and scipy.stats.skew applied to each sample
+    (up to floating point summation order).
+    """
+    lengths = np.diff(offsets)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = segment_reduce(np.add, flat, offsets) / lengths
+        deviation = flat - np.repeat(mean, lengths)
+        squared_deviation = deviation**2
+        m2 = segment_reduce(np.add, squared_deviation, offsets) / lengths
+        m3 = segment_reduce(np.add, squared_deviation*deviation, offsets) / lengths
+        sd = np.sqrt(m2)
+        dist_skew = m3 / m2**1.5
+    # scipy returns nan when the variance is below floating point precision
+    dist_skew[m2 <= (np.finfo(float).resolution * mean)**2] = np.nan
+    dist_skew[sd == 0] = 0
+    df[f"{name}_Mean"] = mean
+    df[f"{name}_SD"] = sd
+    df[f"{name}_Skew"] = dist_skew
+    return df
+
+
+def function_to_features(df, name, flat, offsets):
+    """Function summary statistics, calculated for every sample at once
+
+    NaN values of a function (e.g. the J-function at large radii) are ignored, as
+    np.nanmin and np.nanmax do, and a function of only NaN values gives NaN.
+    Infinite values are kept.
+    """
+    df[f"{name}_Min"] = segment_reduce(np.fmin, flat, offsets)
+    df[f"{name}_Max"] = segment_reduce(np.fmax, flat, offsets)
+    return df
+
+
+def summary_features(df, name, statistic_type, flat, offsets):
+    """Add the summary statistics of a distribution or function statistic to df"""
+    if statistic_type == "distribution":
+        return distribution_to_features(df, name, flat, offsets)
+    return function_to_features(df, name, flat, offsets)
+
+
+def statistic_to_features(statistics_data_path, statistic_name, ragged, ragged_names=()):
+    """Read a statistic, from its pkl or ragged save, and convert it into features
+
+    Parameter sweeps save one column per value in the statistic's pkl,
+    each column is converted into its own features.
+    Columns of the pkl that are also saved as ragged (in ragged_names) are skipped.
+    Features of approximate statistics are flagged with the _Approx suffix, and their
+    confidence interval and budget columns are not converted into features.
+    """
+    if ragged:
+        df_statistic = read_ragged(statistics_data_path, statistic_name)
+        statistic_type = get_spatial_statistic_type(df_statistic, statistic_name)
+        return summary_features(df_statistic.keys.copy(), statistic_name, statistic_type,
+                                df_statistic.values, df_statistic.offsets)
+    df_feature = pd.read_pickle(f"{statistics_data_path}/{statistic_name}.pkl")
+    df_feature = df_feature.drop([c for c in df_feature.columns if c in ragged_names], axis=1)
+    approximate = [c for c in df_feature.columns if f"{c}_budget" in df_feature.columns]
+    df_feature = df_feature.drop(
+        [f"{c}{suffix}" for c in approximate for suffix in APPROXIMATION_SUFFIXES], axis=1
+    )
+    for column in [c for c in df_feature.columns if c not in ("source", "sample")]:
+        statistic_type = get_spatial_statistic_type(df_feature, column)
+        name = f"{column}_Approx" if column in approximate else column
+        if statistic_type == "value":
+            df_feature = df_feature.rename(columns={column: name})
+            continue
+        flat, offsets = flatten_statistic(df_feature[column].values)
+        df_feature = df_feature.drop(column, axis=1)
+        df_feature = summary_features(df_feature, name, statistic_type, flat, offsets)
+    return df_feature
+
+
+def write_features(data_type, label_name, time):
+    """Convert every statistic of the data type and time into features.csv"""
+    statistics_data_path = get_data_path(data_type, "statistics", time)
+    metadata = get_metadata(data_type)
+    df = metadata.frame([label_name])
+    df = df[df[label_name].notna()]
+
+    statistic_files = os.listdir(statistics_data_path)
+    ragged_names = {f[:-len(RAGGED_SUFFIX)] for f in statistic_files if f.endswith(RAGGED_SUFFIX)}
+    for statistic_file in statistic_files:
+        if statistic_file.endswith(RAGGED_SUFFIX):
+            statistic_name = statistic_file[:-len(RAGGED_SUFFIX)]
+            ragged = True
+        elif statistic_file.endswith(".pkl"):
+            statistic_name = statistic_file[:-4]
+            ragged = False
+        else:
+            continue
+        df_feature = statistic_to_features(
+            statistics_data_path, statistic_name, ragged, ragged_names
+        )
+        df = df.join(metadata.index_by_id(df_feature), how="left")
+    # in the order of the samples' names, as merging on them gave
+    df = df.sort_values(["source", "sample"])
+    df.to_csv(f"{statistics_data_path}/features.csv", index=False, na_rep=np.nan)
 
 
 def main():
@@ -45,29 +143,7 @@ def main():
     parser.add_argument("-label", "--label_name", type=str, default="game")
     parser.add_argument("-time", "--time", type=int, default=72)
     args = parser.parse_args()
-
-    data_path = get_data_path(args.data_type, ".")
-    statistics_data_path = get_data_path(args.data_type, "statistics", args.time)
-    df = pd.read_csv(f"{data_path}/labels.csv")
-    df["sample"] = df["sample"].astype(str)
-    df = df[["source", "sample", args.label_name]]
-
-    for statistic_file in os.listdir(statistics_data_path):
-        if not statistic_file.endswith(".pkl"):
-            continue
-        df_feature = pd.read_pickle(f"{statistics_data_path}/{statistic_file}")
-        statistic_name = statistic_file[:-4]
-        statistic_type = get_spatial_statistic_type(df_feature, statistic_name)
-        if statistic_type == "distribution":
-            df_feature = df_feature.apply(distribution_to_features, axis=1, args=(statistic_name,))
-            df_feature = df_feature.drop(statistic_name, axis=1)
-        elif statistic_type == "function":
-            df_feature = df_feature.apply(function_to_features, axis=1, args=(statistic_name,))
-            df_feature = df_feature.drop(statistic_name, axis=1)
-        df_feature["sample"] = df_feature["sample"].astype(str)
-        df = pd.merge(df, df_feature, on=["source", "sample"], how="outer")
-    df = df[df[args.label_name].notna()]
-    df.to_csv(f"{statistics_data_path}/features.csv", index=False, na_rep=np.nan)
+    write_features(args.data_type, args.label_name, args.time)
 
 
 if __name__ == "__main__":
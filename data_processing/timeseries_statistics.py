@@ -0,0 +1,176 @@
+"""Calculate spatial statistics over the timepoints of each sample incrementally.
+
+Each sample's timepoints (data/{data_type}/{time}/processed) are read and processed in
+order. For samples with integer coordinates one IncrementalLattice is kept for the sample
+and updated from the cells that changed since the previous timepoint, instead of the
+statistics rebuilding their structures at every timepoint. The lattice is rebuilt over
+a larger grid when a timepoint's cells fall outside it, and is not used for timepoints
+whose cells are not integral or too sparse for a lattice (see lattice.fits_lattice). Statistics that use the
+sample's lattice (nc_dist, spatial_subsample_dist, qcm with backend="lattice",
+proportion_cell, num_cell) then reuse its incrementally updated neighbor counts,
+quadrat counts, and cell counts. The other statistics are calculated as usual.
+
+The results of each timepoint are saved in its statistics directory, as
+processed_to_statistic does.
+
+Expected usage:
+python3 -m spatial_egt.data_processing.timeseries_statistics -dir data_type -stat names
+    (-times times) (-workers workers) (-ragged)
+
+Where:
+-times: the timepoints to process, all timepoint directories by default
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+
+import numpy as np
+import pandas as pd
+
+from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.processed_to_statistic import (
+    evaluate_statistic,
+    get_statistics,
+    save_statistics,
+)
+from spatial_egt.data_processing.processed_store import read_sample
+from spatial_egt.data_processing.processed_to_store import get_sample_file_names
+from spatial_egt.data_processing.spatial_statistics.lattice import (
+    CELL_TYPES,
+    IncrementalLattice,
+    fits_lattice,
+)
+from spatial_egt.data_processing.spatial_statistics.sample_context import get_context
+
+
+def get_timepoints(data_type):
+    """Timepoints of the data type that have processed samples, in order"""
+    data_path = get_data_path(data_type, ".")
+    return sorted(
+        int(t) for t in os.listdir(data_path)
+        if t.isdigit() and os.path.isdir(f"{data_path}/{t}/processed")
+    )
+
+
+def get_type_coords(df):
+    """Integer coordinates of each cell type, or None if the coordinates are not integral"""
+    context = get_context(df)
+    type_coords = {cell_type: context.coords(cell_type) for cell_type in CELL_TYPES}
+    if not all(np.all(np.mod(coords, 1) == 0) for coords in type_coords.values()):
+        return None
+    return {cell_type: coords.astype(int) for cell_type, coords in type_coords.items()}
+
+
+def update_lattice(lattice, df):
+    """Move the sample's lattice to the cells of the timepoint
+
+    :return: the updated lattice, a new lattice if the cells are outside the previous
+        one's grid, or None if the timepoint should not use a lattice
+    """
+    type_coords = get_type_coords(df)
+    if type_coords is None:
+        return None
+    all_coords = np.concatenate(list(type_coords.values()))
+    if len(all_coords) == 0:
+        return None
+    lower = all_coords.min(axis=0)
+    upper = all_coords.max(axis=0)
+    if lattice is not None:
+        grid_upper = lattice.origin + np.array(lattice.shape) - 1
+        if np.any(lower < lattice.origin) or np.any(upper > grid_upper):
+            lower = np.minimum(lower, lattice.origin)
+            upper = np.maximum(upper, grid_upper)
+            lattice = None
+        else:
+            lower, upper = lattice.origin, grid_upper
+    if not fits_lattice(len(all_coords), lower, upper):
+        return None
+    if lattice is None:
+        lattice = IncrementalLattice(lower, upper)
+    lattice.update(type_coords)
+    return lattice
+
+
+def calculate_sample_timeseries(data_type, times, statistics, file_name):
+    """Calculate each statistic at each timepoint of one sample
+
+    :return: {time: {statistic name: row}}, timepoints missing the sample are left out
+    """
+    try:
+        source = file_name.split(" ")[0]
+        sample = file_name.split(" ")[1][:-4]
+    except Exception as e:
+        print(f"Error {file_name}: {e}")
+        return {}
+    rows = {}
+    lattice = None
+    for time in times:
+        data_path = get_data_path(data_type, "processed", time)
+        if not os.path.exists(f"{data_path}/{file_name}"):
+            continue
+        try:
+            df = read_sample(data_path, file_name)
+            lattice = update_lattice(lattice, df)
+        except Exception as e:
+            print(f"Error {time} {file_name}: {e}")
+            lattice = None
+            continue
+        if lattice is not None:
+            get_context(df).get("lattice", lambda: lattice)
+        rows[time] = {}
+        for stat_name, (stat_calculation, stat_args) in statistics.items():
+            try:
+                columns = evaluate_statistic(df, stat_name, stat_calculation, stat_args)
+            except Exception as e:
+                print(f"Error {time} {file_name} {stat_name}: {e}")
+                continue
+            rows[time][stat_name] = {"source": source, "sample": sample} | columns
+    return rows
+
+
+def calculate_timeseries(data_type, times, file_names, statistics, workers=1):
+    """Calculate the statistics of every sample at every timepoint
+
+    :return: {time: {statistic name: DataFrame}}
+    """
+    calculate_sample = partial(calculate_sample_timeseries, data_type, times, statistics)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            sample_rows = list(executor.map(calculate_sample, file_names))
+    else:
+        sample_rows = [calculate_sample(file_name) for file_name in file_names]
+    return {
+        time: {
+            stat_name: pd.DataFrame([rows[time][stat_name] for rows in sample_rows
+                                     if time in rows and stat_name in rows[time]])
+            for stat_name in statistics
+        }
+        for time in times
+    }
+
+
+def main():
+    """Calculate spatial statistics over time and save them for each timepoint"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--data_type", type=str, default="in_silico")
+    parser.add_argument("-stat", "--statistic", type=str, nargs="+", default=["all"])
+    parser.add_argument("-times", "--times", type=int, nargs="+", default=None)
+    parser.add_argument("-workers", "--workers", type=int, default=1)
+    parser.add_argument("-ragged", "--ragged", action="store_true")
+    args = parser.parse_args()
+
+    times = args.times if args.times is not None else get_timepoints(args.data_type)
+    statistics = get_statistics(args.data_type, args.statistic)
+    file_names = sorted({
+        file_name for time in times
+        for file_name in get_sample_file_names(get_data_path(args.data_type, "processed", time))
+    })
+    dfs = calculate_timeseries(args.data_type, times, file_names, statistics, args.workers)
+    for time, time_dfs in dfs.items():
+        save_statistics(time_dfs, get_data_path(args.data_type, "statistics", time), args.ragged)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,36 @@
-"""Generate bash script for processing coordinates into spatial statistics"""
+"""Generate bash script for processing coordinates into spatial statistics
+
+With -shards, the samples of a statistic are instead split into shards of balanced
+estimated runtime, written to data/{data_type}/{time}/shards/{statistic}/{shard}.txt,
+along with a SLURM job array script where each task calculates one shard's samples in
+a single process. Each sample's runtime is estimated from its number of cells, or from
+a csv of recorded runtimes (columns source, sample, seconds) given to -costs.
+"""
 
 import argparse
+import heapq
+import os
+
+import numpy as np
+import pandas as pd
 
 from spatial_database import STATISTIC_REGISTRY
+from spatial_egt import create_sbatch_job
 from spatial_egt.common import get_data_path
+from spatial_egt.data_processing.processed_store import is_store, open_store
+from spatial_egt.data_processing.processed_to_statistic import get_file_names
+from spatial_egt.data_processing.processed_to_store import get_sample_file_names
 
 
 def write_individual(run_cmd, python_file, data_type, time, statistic):
     """Write run for each sample of a given spatial statistic"""
     processed_path = get_data_path(data_type, "processed", time)
     output = []
-    for sample_file in processed_path:
+    for sample_file in get_sample_file_names(processed_path):
         source = sample_file.split(" ")[0]
         sample = sample_file.split(" ")[1][:-4]
-        output.append(f"{run_cmd} {python_file} {data_type} {statistic} {time} {source} {sample}\n")
+        output.append(f"{run_cmd} {python_file} -dir {data_type} -stat {statistic} -time {time} "
+                      f"-source {source} -sample {sample}\n")
     output_batches = [output[i : i + 900] for i in range(0, len(output), 900)]
     for i, batch in enumerate(output_batches):
         with open(f"run_{data_type}_{time}_{statistic}_{i}.sh", "w", encoding="UTF-8") as f:
@@ -33,6 +50,78 @@ def write_aggregated(run_cmd, python_file, data_type, time, statistic_names):
     get_data_path(data_type, "statistics", time)
 
 
+def count_cells(data_path, file_names):
+    """Number of cells in each sample, from the store's offsets or the csv's lines"""
+    if is_store(data_path):
+        store = open_store(data_path)
+        num_cells = np.diff(store.offsets)
+        return np.array([num_cells[store.sample_index[f]] for f in file_names])
+    counts = []
+    for file_name in file_names:
+        with open(f"{data_path}/{file_name}", "rb") as f:
+            counts.append(sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b"")) - 1)
+    return np.array(counts)
+
+
+def estimate_costs(data_path, file_names, costs_file=None):
+    """Estimated runtime of each sample
+
+    Samples with a recorded runtime use it, the others are estimated from their
+    number of cells, scaled by the median runtime per cell of the recorded samples.
+    """
+    costs = count_cells(data_path, file_names).astype(float)
+    if costs_file is None:
+        return costs
+    df = pd.read_csv(costs_file, dtype={"source": str, "sample": str})
+    df = df.groupby(["source", "sample"])["seconds"].mean()
+    recorded = {f"{source} {sample}.csv": seconds for (source, sample), seconds in df.items()}
+    known = np.array([f in recorded for f in file_names])
+    if np.any(known):
+        known_seconds = np.array([recorded[f] for f in np.array(file_names)[known]])
+        seconds_per_cell = np.median(known_seconds / np.maximum(costs[known], 1))
+        costs = costs*seconds_per_cell
+        costs[known] = known_seconds
+    return costs
+
+
+def balance_shards(costs, num_shards):
+    """Assign each item to a shard, longest first to the shard with the least total cost"""
+    shards = [[] for _ in range(num_shards)]
+    heap = [(0.0, i) for i in range(num_shards)]
+    for item in np.argsort(-costs, kind="stable"):
+        total, shard = heapq.heappop(heap)
+        shards[shard].append(item)
+        heapq.heappush(heap, (total + costs[item], shard))
+    return shards
+
+
+def write_sharded(python_file, data_type, time, statistic, num_shards, costs_file, sbatch_args, store):
+    """Write balanced shards of samples and the job array script running them"""
+    data_path = get_data_path(data_type, "store" if store else "processed", time)
+    file_names = get_file_names(data_path, store)
+    if len(file_names) == 0:
+        print(f"No samples in {data_path}, no shards written")
+        return
+    costs = estimate_costs(data_path, file_names, costs_file)
+    shards = balance_shards(costs, min(num_shards, len(file_names)))
+
+    shard_path = get_data_path(data_type, f"shards/{statistic}", time)
+    for i, shard in enumerate(shards):
+        with open(f"{shard_path}/{i}.txt", "w", encoding="UTF-8") as f:
+            for item in shard:
+                f.write(f"{file_names[item]}\n")
+    shard_costs = [costs[shard].sum() for shard in shards]
+    print(f"{len(shards)} shards, estimated cost min {min(shard_costs):.4g} max {max(shard_costs):.4g}")
+
+    name = f"{data_type}_{time}_{statistic}"
+    create_sbatch_job.main(name=name, array=len(shards), **sbatch_args)
+    store_flag = " -store" if store else ""
+    with open(f"run_{name}_array.sh", "w", encoding="UTF-8") as f:
+        f.write(f"sbatch job_{name}.sb {python_file} -dir {data_type} -stat {statistic} -time {time}"
+                f"{store_flag} -samples {shard_path}/%a.txt\n")
+    get_data_path(data_type, f"statistics/{statistic}", time)
+
+
 def main():
     """Generate and save bash script"""
     parser = argparse.ArgumentParser()
@@ -40,11 +129,25 @@ def main():
     parser.add_argument("-time", "--time", type=int, default=72)
     parser.add_argument("-run_cmd", "--run_cmd", type=str, default="python3 -m")
     parser.add_argument("-stat", "--statistic", type=str, default=None)
+    parser.add_argument("-shards", "--shards", type=int, default=None)
+    parser.add_argument("-costs", "--costs", type=str, default=None)
+    parser.add_argument("-store", "--store", action="store_true")
+    parser.add_argument("-email", "--email", type=str, default=None)
+    parser.add_argument("-job_time", "--job_time", type=str, default="00-04:00")
+    parser.add_argument("-memory", "--memory", type=str, default="4gb")
+    parser.add_argument("-conda_env", "--conda_env", type=str, default="spatial_egt")
+    parser.add_argument("-path", "--path", type=str, default=os.getcwd())
+    parser.add_argument("-node", "--node", type=str, default=None)
     args = parser.parse_args()
 
     python_file = "spatial_egt.data_processing.processed_to_statistic"
     if args.statistic is None:
         write_aggregated(args.run_cmd, python_file, args.data_type, args.time, STATISTIC_REGISTRY.keys())
+    elif args.shards is not None:
+        sbatch_args = dict(email=args.email, time=args.job_time, memory=args.memory,
+                           conda_env=args.conda_env, path=args.path, node=args.node)
+        write_sharded(python_file, args.data_type, args.time, args.statistic,
+                      args.shards, args.costs, sbatch_args, args.store)
     else:
         write_individual(args.run_cmd, python_file, args.data_type, args.time, args.statistic)
 
@@ -0,0 +1,226 @@
+"""Run the processing pipeline locally, rebuilding only what changed.
+
+The stages and their file level inputs and outputs under data/{data_type}/{time}/ are:
+statistic: processed/ (or store/) -> statistics/{statistic}.pkl (or .ragged), one per statistic
+features: statistics/* and data/{data_type}/labels.csv -> statistics/features.csv
+classify: statistics/features.csv -> outputs of the given classification scripts
+
+Each artifact is stamped in statistics/pipeline.json with a signature of its inputs:
+the sizes and modification times of the input files, the statistic's arguments and
+the source code of the modules calculating it (as for the statistic_cache), of
+the modules writing the features, or of the classification modules. An artifact is only rebuilt when its
+signature changed or its outputs are missing, so after changing one statistic only that
+statistic, the features, and the classification are redone.
+Statistics that need rebuilding are calculated together with the samples spread across
+a process pool, so each sample is read once and the structures its statistics share
+(see sample_context) are built once.
+Samples are aggregated directly, so combine_sample_statistics is not needed locally.
+
+Expected usage:
+python3 -m spatial_egt.pipeline -dir data_type (-time time) (-stat names) (-label label_name)
+    (-workers workers) (-store) (-cache) (-ragged) (-classify modules) (-features names) (-force)
+    (-ledger)
+
+Where:
+-stat: the statistics to calculate, all registered statistics by default
+-classify: classification modules to run on the features, e.g. model_eval
+-features: the feature set/names given to the classification modules
+-force: rebuild every artifact
+-ledger: record the cost of each statistic on each sample in the run_ledger
+"""
+
+import argparse
+from glob import glob
+import hashlib
+import inspect
+import json
+import os
+import subprocess
+import sys
+
+from spatial_egt import common
+from spatial_egt.common import get_data_path
+from spatial_egt.data_processing import (
+    processed_to_statistic,
+    ragged_statistics,
+    sample_metadata,
+    statistics_to_features,
+)
+from spatial_egt.data_processing.run_ledger import LEDGER_FILE, RunLedger
+from spatial_egt.data_processing.spatial_statistics import approximate
+from spatial_egt.data_processing.statistic_cache import (
+    StatisticCache,
+    get_code_version,
+    get_statistic_code_version,
+)
+
+
+STAMP_FILE = "pipeline.json"
+# modules features.csv is written with
+FEATURE_MODULES = [statistics_to_features, ragged_statistics, sample_metadata, approximate, common]
+CLASSIFICATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "classification")
+
+
+def get_signature(*parts):
+    """Hash of the JSON representation of parts"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_file_fingerprint(path, exclude=()):
+    """Names, sizes, and modification times of a file or every file under a directory
+
+    :param exclude: names of files under the directory to leave out
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [[os.path.basename(path), stat.st_size, stat.st_mtime_ns]]
+    fingerprint = []
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            if file_name in exclude:
+                continue
+            stat = os.stat(f"{root}/{file_name}")
+            fingerprint.append([os.path.relpath(f"{root}/{file_name}", path),
+                                stat.st_size, stat.st_mtime_ns])
+    return sorted(fingerprint)
+
+
+def read_stamps(statistics_path):
+    try:
+        with open(f"{statistics_path}/{STAMP_FILE}", encoding="UTF-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_stamps(statistics_path, stamps):
+    """Save the stamps, writing to a temporary file first so an interrupted run keeps the old ones"""
+    temp_file_name = f"{statistics_path}/{STAMP_FILE}.tmp"
+    with open(temp_file_name, "w", encoding="UTF-8") as f:
+        json.dump(stamps, f, indent=1, sort_keys=True)
+    os.replace(temp_file_name, f"{statistics_path}/{STAMP_FILE}")
+
+
+def is_current(stamps, artifact, signature, statistics_path):
+    """If the artifact was built from the same inputs and its outputs still exist"""
+    stamp = stamps.get(artifact)
+    if stamp is None or stamp["signature"] != signature:
+        return False
+    return all(os.path.exists(f"{statistics_path}/{output}") for output in stamp["outputs"])
+
+
+def statistic_signature(stat_calculation, stat_args, input_fingerprint, ragged):
+    """Signature of a statistic's inputs"""
+    code_version = get_statistic_code_version(stat_calculation)
+    return get_signature(stat_calculation.__name__, stat_args, code_version, input_fingerprint, ragged)
+
+
+def run_statistics(data_type, time, stat_names, workers=1, store=False, ragged=False,
+                   cache=False, ledger=None):
+    """Calculate the statistics on every sample and save them
+
+    :return: the saved file names of each statistic that was calculated on any sample
+    """
+    stage = "store" if store else "processed"
+    data_path = get_data_path(data_type, stage, time)
+    statistics = processed_to_statistic.get_statistics(data_type, stat_names)
+    file_names = processed_to_statistic.get_file_names(data_path, store)
+    statistic_cache = StatisticCache(get_data_path(data_type, "cache")) if cache else None
+    dfs = processed_to_statistic.calculate_statistics(
+        data_path, file_names, statistics, workers, statistic_cache, ledger
+    )
+    statistics_path = get_data_path(data_type, "statistics", time)
+    return {
+        stat_name: processed_to_statistic.save_statistics({stat_name: df}, statistics_path, ragged)
+        for stat_name, df in dfs.items() if len(df) > 0
+    }
+
+
+def classification_code_version():
+    """Hash of every classification module and common, which the scripts import"""
+    module_files = sorted(glob(f"{CLASSIFICATION_PATH}/*.py"))
+    return get_code_version(*module_files, inspect.getsourcefile(common))
+
+
+def run_classification(module, data_type, time, label_name, feature_names):
+    """Run a classification script in its own process, as from the command line"""
+    command = [sys.executable, "-m", f"spatial_egt.classification.{module}",
+               data_type, str(time), label_name, *feature_names]
+    subprocess.run(command, check=True)
+
+
+def main():
+    """Run the stages of the pipeline that are out of date"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--data_type", type=str, default="in_silico")
+    parser.add_argument("-time", "--time", type=int, default=72)
+    parser.add_argument("-stat", "--statistic", type=str, nargs="+", default=["all"])
+    parser.add_argument("-label", "--label_name", type=str, default="game")
+    parser.add_argument("-workers", "--workers", type=int, default=1)
+    parser.add_argument("-store", "--store", action="store_true")
+    parser.add_argument("-cache", "--cache", action="store_true")
+    parser.add_argument("-ragged", "--ragged", action="store_true")
+    parser.add_argument("-classify", "--classify", type=str, nargs="+", default=[])
+    parser.add_argument("-features", "--features", type=str, nargs="+", default=["all"])
+    parser.add_argument("-force", "--force", action="store_true")
+    parser.add_argument("-ledger", "--ledger", action="store_true")
+    args = parser.parse_args()
+
+    stage = "store" if args.store else "processed"
+    input_fingerprint = get_file_fingerprint(get_data_path(args.data_type, stage, args.time))
+    statistics_path = get_data_path(args.data_type, "statistics", args.time)
+    stamps = {} if args.force else read_stamps(statistics_path)
+    ledger = None
+    if args.ledger:
+        ledger = RunLedger(f"{get_data_path(args.data_type, '.')}/{LEDGER_FILE}")
+
+    # statistics
+    signatures = {}
+    stale = []
+    statistics = processed_to_statistic.get_statistics(args.data_type, args.statistic)
+    for stat_name, (stat_calculation, stat_args) in statistics.items():
+        signature = statistic_signature(stat_calculation, stat_args, input_fingerprint, args.ragged)
+        signatures[stat_name] = signature
+        if not is_current(stamps, stat_name, signature, statistics_path):
+            stale.append(stat_name)
+    print(f"Calculating {len(stale)} of {len(statistics)} statistics: {' '.join(stale)}")
+    if len(stale) > 0:
+        outputs = run_statistics(args.data_type, args.time, stale, args.workers, args.store,
+                                 args.ragged, args.cache, ledger)
+        for stat_name in stale:
+            if stat_name not in outputs:
+                print(f"Error {stat_name}: not calculated on any sample")
+                continue
+            stamps[stat_name] = {"signature": signatures[stat_name], "outputs": outputs[stat_name]}
+        write_stamps(statistics_path, stamps)
+
+    # features
+    labels_file = f"{get_data_path(args.data_type, '.')}/labels.csv"
+    statistics_fingerprint = get_file_fingerprint(
+        statistics_path, exclude=("features.csv", STAMP_FILE, f"{STAMP_FILE}.tmp")
+    )
+    features_signature = get_signature(
+        statistics_fingerprint, get_file_fingerprint(labels_file), args.label_name,
+        get_code_version(*(inspect.getsourcefile(module) for module in FEATURE_MODULES))
+    )
+    if not is_current(stamps, "features", features_signature, statistics_path):
+        print("Writing features")
+        statistics_to_features.write_features(args.data_type, args.label_name, args.time)
+        stamps["features"] = {"signature": features_signature, "outputs": ["features.csv"]}
+        write_stamps(statistics_path, stamps)
+
+    # classification
+    classification_code = classification_code_version() if args.classify else None
+    for module in args.classify:
+        artifact = f"classify {module} {' '.join(args.features)}"
+        signature = get_signature(features_signature, args.label_name, classification_code)
+        if is_current(stamps, artifact, signature, statistics_path):
+            continue
+        print(f"Running {module}")
+        run_classification(module, args.data_type, args.time, args.label_name, args.features)
+        stamps[artifact] = {"signature": signature, "outputs": []}
+        write_stamps(statistics_path, stamps)
+
+
+if __name__ == "__main__":
+    main()